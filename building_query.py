@@ -0,0 +1,330 @@
+"""
+建筑特征查询服务
+
+从持久化的空间索引(按Hilbert曲线排序的packed R-tree + 列式建筑表)中加载城市建筑,
+对任意GeoJSON多边形计算与get_building_feature相同的指标, 不需要重跑整个流程
+
+运行
+```
+python building_query.py --city nyc --query zones.geojson
+python building_query.py --city nyc --serve --port 8765
+```
+"""
+
+import os
+import json
+import argparse
+import hashlib
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import numpy as np
+import shapely
+from shapely.geometry import shape
+from pyproj import Geod
+
+from building_table import BuildingTable
+
+geod = Geod(ellps="WGS84")
+
+NODE_SIZE = 16
+HILBERT_BITS = 16
+FEATURE_NAMES = [
+    "building_num",
+    "area_mean",
+    "area_sum",
+    "height_mean",
+    "volume_sum",
+    "complexity_mean",
+    "building_density",
+    "plot_ratio",
+    "pop_building_sum",
+]
+
+
+def hilbert_index(x, y, bits=HILBERT_BITS):
+    """
+    计算整数网格坐标在Hilbert曲线上的序号(向量化)
+
+    Input:
+        x, y: [0, 2**bits)之间的整数数组
+
+    Output:
+        d: Hilbert序号, int64数组
+    """
+    x = np.asarray(x, dtype=np.int64).copy()
+    y = np.asarray(y, dtype=np.int64).copy()
+    n = 1 << bits
+    d = np.zeros_like(x)
+    s = n >> 1
+    while s > 0:
+        rx = (x & s) > 0
+        ry = (y & s) > 0
+        d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+        flip = ~ry & rx
+        x = np.where(flip, n - 1 - x, x)
+        y = np.where(flip, n - 1 - y, y)
+        swap = ~ry
+        x, y = np.where(swap, y, x), np.where(swap, x, y)
+        s >>= 1
+    return d
+
+
+def hilbert_order(bounds):
+    """
+    按外包框中心的Hilbert序排列的下标, 中心坐标归一化到[0, 2**HILBERT_BITS)的整数网格
+
+    Input:
+        bounds: (N, 4)的[minx, miny, maxx, maxy]
+    """
+    if len(bounds) == 0:
+        return np.zeros(0, dtype=np.int64)
+    center_x = (bounds[:, 0] + bounds[:, 2]) / 2
+    center_y = (bounds[:, 1] + bounds[:, 3]) / 2
+    scale = (1 << HILBERT_BITS) - 1
+    span_x = max(center_x.max() - center_x.min(), 1e-12)
+    span_y = max(center_y.max() - center_y.min(), 1e-12)
+    hx = ((center_x - center_x.min()) / span_x * scale).astype(np.int64)
+    hy = ((center_y - center_y.min()) / span_y * scale).astype(np.int64)
+    return np.argsort(hilbert_index(hx, hy), kind="stable")
+
+
+def build_packed_rtree(bounds, node_size=NODE_SIZE):
+    """
+    自底向上构建packed R-tree, bounds需已按Hilbert序排好
+
+    Input:
+        bounds: (N, 4)的建筑外包框 [minx, miny, maxx, maxy]
+
+    Output:
+        levels: 每一层节点外包框的列表, levels[0]为叶子(即建筑本身), levels[-1]为根
+    """
+    levels = [bounds]
+    while levels[-1].shape[0] > 1:
+        child = levels[-1]
+        starts = np.arange(0, child.shape[0], node_size)
+        parent = np.column_stack(
+            [
+                np.minimum.reduceat(child[:, 0], starts),
+                np.minimum.reduceat(child[:, 1], starts),
+                np.maximum.reduceat(child[:, 2], starts),
+                np.maximum.reduceat(child[:, 3], starts),
+            ]
+        )
+        levels.append(parent)
+    return levels
+
+
+def save_building_index(table, index_dir):
+    """
+    将get_building_feature之后的建筑表保存为可内存映射的空间索引
+
+    Input:
+        table: 已计算area, complexity的BuildingTable(EPSG:4326)
+        index_dir: 索引保存的文件夹
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    bounds = shapely.bounds(table.geometry())
+
+    # 按外包框中心的Hilbert序排序, 使空间上相近的建筑在磁盘上也相邻
+    order = hilbert_order(bounds)
+
+    table.take(order).save(os.path.join(index_dir, "table"))
+    levels = build_packed_rtree(np.ascontiguousarray(bounds[order]))
+    for i, level in enumerate(levels):
+        np.save(os.path.join(index_dir, f"tree_{i}.npy"), level)
+
+    with open(os.path.join(index_dir, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "count": int(bounds.shape[0]),
+                "node_size": NODE_SIZE,
+                "levels": len(levels),
+            },
+            f,
+        )
+    print("building index saved:", index_dir, "building nums =", bounds.shape[0])
+
+
+class BuildingIndex:
+    """
+    内存映射的建筑空间索引, 带按几何哈希的LRU缓存
+    """
+
+    def __init__(self, index_dir, cache_size=1024):
+        meta = json.load(open(os.path.join(index_dir, "meta.json")))
+        self.node_size = meta["node_size"]
+        self.levels = [
+            np.load(os.path.join(index_dir, f"tree_{i}.npy"), mmap_mode="r")
+            for i in range(meta["levels"])
+        ]
+        self.table = BuildingTable.load(os.path.join(index_dir, "table"))
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+
+    def search(self, bbox):
+        """
+        在packed R-tree中查找外包框与bbox相交的建筑序号
+        """
+        minx, miny, maxx, maxy = bbox
+        nodes = np.arange(self.levels[-1].shape[0])
+        for level in range(len(self.levels) - 1, -1, -1):
+            b = self.levels[level][nodes]
+            hit = (
+                (b[:, 0] <= maxx)
+                & (b[:, 2] >= minx)
+                & (b[:, 1] <= maxy)
+                & (b[:, 3] >= miny)
+            )
+            nodes = nodes[hit]
+            if level == 0 or nodes.size == 0:
+                break
+            n_child = self.levels[level - 1].shape[0]
+            nodes = (
+                nodes[:, None] * self.node_size + np.arange(self.node_size)
+            ).ravel()
+            nodes = nodes[nodes < n_child]
+        return nodes
+
+    def geometries(self, idx):
+        """
+        从坐标列中还原指定序号的建筑几何
+        """
+        return self.table.take(idx).geometry()
+
+    def within(self, polygon):
+        """
+        返回完全位于polygon内的建筑序号, 与gpd.sjoin(predicate="within")一致
+        """
+        candidates = self.search(polygon.bounds)
+        if candidates.size == 0:
+            return candidates
+        shapely.prepare(polygon)
+        # 外包框已在多边形内的建筑无需解码几何
+        b = self.levels[0][candidates]
+        inside = shapely.within(
+            shapely.box(b[:, 0], b[:, 1], b[:, 2], b[:, 3]), polygon
+        )
+        rest = candidates[~inside]
+        if rest.size:
+            rest = rest[shapely.within(self.geometries(rest), polygon)]
+        return np.sort(np.concatenate([candidates[inside], rest]))
+
+    def features(self, polygon, aland=None):
+        """
+        计算polygon内的建筑指标
+
+        Input:
+            polygon: shapely多边形(EPSG:4326)
+            aland: 区域陆地面积, 缺省时使用多边形的测地面积
+
+        Output:
+            指标字典, 字段见FEATURE_NAMES
+        """
+        if aland is None:
+            aland = abs(geod.geometry_area_perimeter(polygon)[0])
+        idx = self.within(polygon)
+        if idx.size == 0:
+            info = {name: 0.0 for name in FEATURE_NAMES}
+            info["building_num"] = 0
+            return info
+        area = self.table.area[idx]
+        height = self.table.height[idx]
+        area_sum = float(area.sum())
+        volume_sum = float((area * height).sum())
+        return {
+            "building_num": int(idx.size),
+            "area_mean": float(area.mean()),
+            "area_sum": area_sum,
+            "height_mean": float(height.mean()),
+            "volume_sum": volume_sum,
+            "complexity_mean": float(self.table.complexity[idx].mean()),
+            "building_density": area_sum / aland if aland else 0.0,
+            "plot_ratio": volume_sum / aland if aland else 0.0,
+            "pop_building_sum": float(np.nansum(self.table.population[idx])),
+        }
+
+    def query(self, polygon, aland=None):
+        """
+        带LRU缓存的features, 缓存键为规范化几何的哈希
+        """
+        key = hashlib.sha1(shapely.to_wkb(shapely.normalize(polygon))).hexdigest()
+        key = (key, aland)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        info = self.features(polygon, aland)
+        self.cache[key] = info
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return info
+
+    def query_geojson(self, geojson):
+        """
+        查询GeoJSON(FeatureCollection, Feature或Geometry)中的每个多边形
+
+        Output:
+            {区域id: 指标字典}, 区域id取properties中的GEOID, 其次为feature id, 最后为序号
+        """
+        if geojson.get("type") == "FeatureCollection":
+            features = geojson["features"]
+        elif geojson.get("type") == "Feature":
+            features = [geojson]
+        else:
+            features = [{"type": "Feature", "geometry": geojson, "properties": {}}]
+
+        result = {}
+        for i, feature in enumerate(features):
+            properties = feature.get("properties") or {}
+            region_id = properties.get("GEOID", feature.get("id", i))
+            aland = properties.get("ALAND")
+            aland = float(aland) if aland is not None else None
+            result[str(region_id)] = self.query(shape(feature["geometry"]), aland)
+        return result
+
+
+def serve(index, port):
+    """
+    启动HTTP查询服务, POST GeoJSON到/query返回指标
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/query":
+                self.send_error(404)
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                result = index.query_geojson(json.loads(body))
+            except Exception as e:
+                self.send_error(400, str(e))
+                return
+            data = json.dumps(result).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+    server = HTTPServer(("127.0.0.1", port), Handler)
+    print(f"serving on http://127.0.0.1:{port}/query")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--city", type=str, default="nyc")
+    parser.add_argument("--query", type=str, help="GeoJSON file of regions to query")
+    parser.add_argument("--serve", action="store_true", help="start the HTTP server")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--cache-size", type=int, default=1024)
+    args = parser.parse_args()
+
+    index = BuildingIndex(f"./data/data_{args.city}/building_index", args.cache_size)
+    if args.query:
+        print(json.dumps(index.query_geojson(json.load(open(args.query))), indent=4))
+    if args.serve:
+        serve(index, args.port)
@@ -0,0 +1,310 @@
+"""
+紧凑的数组化建筑表
+
+坐标保存在一个连续的float64数组中, 由环/部件/要素三层偏移量索引(GeoArrow格式),
+height, GEOID编码, area, complexity均为NumPy列, 不再携带properties字典和tract的所有列
+"""
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+import shapely
+from pyproj import Geod
+
+geod = Geod(ellps="WGS84")
+
+
+def _ranges(starts, ends):
+    """
+    拼接多个[start, end)区间为一个下标数组(向量化)
+    """
+    lengths = ends - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+    shift = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return shift + np.arange(total)
+
+
+def take_ragged(coords, offsets, idx):
+    """
+    从ragged数组中取出idx对应的要素, 重新计算偏移量
+
+    Output:
+        coords, offsets: 与shapely.from_ragged_array的输入一致
+    """
+    sel = idx
+    new_offsets = []
+    for level in reversed(offsets):
+        starts = np.asarray(level[sel], dtype=np.int64)
+        ends = np.asarray(level[sel + 1], dtype=np.int64)
+        new_offsets.append(np.concatenate([[0], np.cumsum(ends - starts)]))
+        sel = _ranges(starts, ends)
+    return np.asarray(coords[sel]), tuple(reversed(new_offsets))
+
+
+def building_features(geometry):
+    """
+    计算建筑的测地面积与形状复杂度ERI
+
+    Input:
+        geometry: 建筑几何数组(EPSG:4326)
+
+    Output:
+        area: 测地面积(平方米)
+        complexity: ERI, 与建筑等面积的最小外接矩形周长 / 建筑周长
+    """
+    area = np.array([abs(geod.geometry_area_perimeter(g)[0]) for g in geometry])
+
+    polygon_area = shapely.area(geometry)
+    min_rect = shapely.minimum_rotated_rectangle(geometry)
+    rect_area = shapely.area(min_rect)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scale_factor = polygon_area / rect_area
+        complexity = scale_factor * shapely.length(min_rect) / shapely.length(geometry)
+    return area, np.where(rect_area == 0, 1.0, complexity)
+
+
+class BuildingTable:
+    """
+    数组化的建筑表
+
+    Attributes:
+        geometry_type: shapely.GeometryType, 一般为POLYGON或MULTIPOLYGON
+        coords: (M, 2)的float64坐标
+        offsets: 由内到外的偏移量元组, 与shapely.to_ragged_array一致
+        height: 建筑高度(米)
+        geoid_code: 建筑所在区域在geoids中的下标
+        geoids: 区域GEOID
+        area: 建筑测地面积(平方米), 由compute_features填充
+        complexity: 建筑形状复杂度ERI, 由compute_features填充
+        population: 建筑人口, 由dasymetric.py的分配结果填充
+    """
+
+    def __init__(
+        self,
+        geometry_type,
+        coords,
+        offsets,
+        height,
+        geoid_code,
+        geoids,
+        area=None,
+        complexity=None,
+        population=None,
+    ):
+        self.geometry_type = shapely.GeometryType(int(geometry_type))
+        self.coords = coords
+        self.offsets = tuple(offsets)
+        self.height = height
+        self.geoid_code = geoid_code
+        self.geoids = geoids
+        n = len(height)
+        self.area = np.full(n, np.nan) if area is None else area
+        self.complexity = np.full(n, np.nan) if complexity is None else complexity
+        self.population = np.full(n, np.nan) if population is None else population
+
+    def __len__(self):
+        return len(self.height)
+
+    @property
+    def nbytes(self):
+        arrays = [self.coords, *self.offsets, self.height, self.geoid_code]
+        arrays += [self.area, self.complexity, self.population]
+        return sum(a.nbytes for a in arrays)
+
+    @classmethod
+    def from_geometries(cls, geometry, height, geoid):
+        """
+        由shapely几何数组, 高度和GEOID构建建筑表
+
+        Input:
+            geometry: shapely几何数组(EPSG:4326)
+            height: 建筑高度
+            geoid: 每个建筑所在区域的GEOID
+        """
+        if len(geometry) == 0:
+            # shapely.to_ragged_array不接受空数组
+            geometry_type = shapely.GeometryType.POLYGON
+            coords = np.zeros((0, 2))
+            offsets = (np.zeros(1, dtype=np.int64), np.zeros(1, dtype=np.int64))
+        else:
+            geometry_type, coords, offsets = shapely.to_ragged_array(
+                np.asarray(geometry, dtype=object)
+            )
+        geoid_code, geoids = pd.factorize(np.asarray(geoid), sort=True)
+        return cls(
+            geometry_type,
+            coords,
+            offsets,
+            np.asarray(height, dtype=np.float64),
+            geoid_code.astype(np.int32),
+            np.asarray(geoids, dtype=str),
+        )
+
+    @classmethod
+    def concat(cls, tables):
+        """
+        按顺序拼接多个建筑表(如各quadkey分区), 合并GEOID编码, 保留已计算的列
+        """
+        tables = [t for t in tables if len(t)]
+        if not tables:
+            return cls.from_geometries([], [], [])
+        geoids = np.unique(np.concatenate([t.geoids for t in tables]))
+        geoid_code = [np.searchsorted(geoids, t.geoids)[t.geoid_code] for t in tables]
+        geometry_type, coords, offsets = shapely.to_ragged_array(
+            np.concatenate([t.geometry() for t in tables])
+        )
+
+        def column(name):
+            return np.concatenate([np.asarray(getattr(t, name)) for t in tables])
+
+        return cls(
+            geometry_type,
+            coords,
+            offsets,
+            column("height"),
+            np.concatenate(geoid_code).astype(np.int32),
+            geoids,
+            column("area"),
+            column("complexity"),
+            column("population"),
+        )
+
+    def geometry(self):
+        """
+        转换为shapely几何数组, 用于需要几何运算的步骤
+        """
+        return shapely.from_ragged_array(self.geometry_type, self.coords, self.offsets)
+
+    def to_geodataframe(self):
+        """
+        转换为GeoDataFrame, 仅用于可视化等需要DataFrame的场景
+        """
+        import geopandas as gpd
+
+        return gpd.GeoDataFrame(
+            {"height": self.height, "GEOID": self.geoids[self.geoid_code]},
+            geometry=self.geometry(),
+            crs="EPSG:4326",
+        )
+
+    def take(self, idx):
+        """
+        按下标取出子表, 重新计算偏移量
+        """
+        idx = np.asarray(idx, dtype=np.int64)
+        coords, offsets = take_ragged(self.coords, self.offsets, idx)
+        return BuildingTable(
+            self.geometry_type,
+            coords,
+            offsets,
+            np.asarray(self.height[idx]),
+            np.asarray(self.geoid_code[idx]),
+            self.geoids,
+            np.asarray(self.area[idx]),
+            np.asarray(self.complexity[idx]),
+            np.asarray(self.population[idx]),
+        )
+
+    def compute_features(self, workers=1):
+        """
+        计算每个建筑的测地面积与形状复杂度ERI, workers大于1时按空间分片多进程计算
+        """
+        if workers > 1:
+            import parallel
+
+            geometry = self.geometry()
+            shards = parallel.spatial_shards(shapely.bounds(geometry), workers * 4)
+            results = parallel.map_shards(
+                parallel.features_task,
+                parallel.ragged_arrays(geometry),
+                shards,
+                workers,
+            )
+            self.area = parallel.scatter(results, shards, len(self), "area")
+            self.complexity = parallel.scatter(results, shards, len(self), "complexity")
+        else:
+            self.area, self.complexity = building_features(self.geometry())
+
+    def aggregate(self):
+        """
+        按GEOID聚合建筑指标
+
+        Output:
+            DataFrame, 列为GEOID, area_mean, area_sum, height_mean, volume_sum, complexity_mean
+        """
+        n = len(self.geoids)
+        code = self.geoid_code
+        count = np.bincount(code, minlength=n)
+        area_sum = np.bincount(code, weights=self.area, minlength=n)
+        height_sum = np.bincount(code, weights=self.height, minlength=n)
+        volume_sum = np.bincount(code, weights=self.area * self.height, minlength=n)
+        complexity_sum = np.bincount(code, weights=self.complexity, minlength=n)
+        keep = count > 0
+        count = count[keep]
+        return pd.DataFrame(
+            {
+                "GEOID": self.geoids[keep],
+                "area_mean": area_sum[keep] / count,
+                "area_sum": area_sum[keep],
+                "height_mean": height_sum[keep] / count,
+                "volume_sum": volume_sum[keep],
+                "complexity_mean": complexity_sum[keep] / count,
+            }
+        )
+
+    def save(self, table_dir):
+        """
+        按列保存为.npy文件
+        """
+        os.makedirs(table_dir, exist_ok=True)
+        columns = {
+            "coords": self.coords,
+            "height": self.height,
+            "geoid_code": self.geoid_code,
+            "geoids": self.geoids,
+            "area": self.area,
+            "complexity": self.complexity,
+            "population": self.population,
+        }
+        for i, offsets in enumerate(self.offsets):
+            columns[f"offsets_{i}"] = offsets
+        for name, values in columns.items():
+            np.save(os.path.join(table_dir, f"{name}.npy"), np.asarray(values))
+        with open(os.path.join(table_dir, "table.json"), "w") as f:
+            json.dump(
+                {
+                    "geometry_type": int(self.geometry_type),
+                    "offsets": len(self.offsets),
+                    "count": len(self),
+                },
+                f,
+            )
+
+    @classmethod
+    def load(cls, table_dir, mmap=True):
+        """
+        读取save保存的建筑表, mmap为True时以内存映射方式加载
+        """
+        meta = json.load(open(os.path.join(table_dir, "table.json")))
+        mmap_mode = "r" if mmap else None
+        population_file = os.path.join(table_dir, "population.npy")
+
+        def load(name):
+            return np.load(os.path.join(table_dir, f"{name}.npy"), mmap_mode=mmap_mode)
+
+        return cls(
+            meta["geometry_type"],
+            load("coords"),
+            [load(f"offsets_{i}") for i in range(meta["offsets"])],
+            load("height"),
+            load("geoid_code"),
+            np.load(os.path.join(table_dir, "geoids.npy")),
+            load("area"),
+            load("complexity"),
+            # 早期保存的建筑表没有population列
+            load("population") if os.path.exists(population_file) else None,
+        )
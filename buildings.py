@@ -0,0 +1,93 @@
+"""
+统一命令行入口
+
+```
+python buildings.py ms --city nyc
+python buildings.py cn --city bj
+python buildings.py world
+python buildings.py check
+python buildings.py status
+```
+各子命令的参数与对应脚本一致, 重型依赖(geopandas, rasterio, osmnx, folium等)只在用到的阶段导入,
+check/status只检查文件, 不导入这些依赖
+"""
+
+import os
+import sys
+import json
+import argparse
+import importlib
+
+COMMANDS = {
+    "ms": "get_MS_buildings",
+    "cn": "get_CN_buildings",
+    "world": "get_world_city_footprint",
+    "check": None,
+    "status": None,
+}
+MS_CITIES = ["DC", "BM", "nyc"]
+CN_CITIES = ["bj", "jn", "sz"]
+CITY_OUTPUTS = [
+    "region2info_building.json",
+    "building_index",
+    "grid_stats.npz",
+    "manifest.json",
+    "visual.html",
+]
+
+
+def run_pipeline(command, argv):
+    """
+    运行MS, CN或world流程, 参数由对应脚本的add_arguments定义
+    """
+    module = importlib.import_module(COMMANDS[command])
+    parser = argparse.ArgumentParser(prog=f"buildings.py {command}")
+    module.add_arguments(parser)
+    args = parser.parse_args(argv)
+    module.args = args
+
+    if command == "world":
+        if args.mode == "check":
+            module.check_city_footprint(json.load(open("./data/bldg/cities.json")))
+        elif args.mode == "compare":
+            module.compare_city_coverage(json.load(open("./data/bldg/cities.json")))
+        else:
+            module.main()
+    else:
+        module.main(args.city)
+
+
+def check():
+    """
+    检查世界城市流程的完成情况
+    """
+    from get_world_city_footprint import check_city_footprint
+
+    check_city_footprint(json.load(open("./data/bldg/cities.json")))
+
+
+def status():
+    """
+    检查MS和CN城市的输出文件
+    """
+    for name, cities in [("MS", MS_CITIES), ("CN", CN_CITIES)]:
+        for city in cities:
+            folder = f"./data/data_{city}/"
+            done = [f for f in CITY_OUTPUTS if os.path.exists(folder + f)]
+            print(f"{name}/{city}: {', '.join(done) if done else '-'}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="building features pipelines",
+        epilog="run `buildings.py <command> --help` for the options of a command",
+    )
+    parser.add_argument("command", choices=list(COMMANDS))
+    args = parser.parse_args(sys.argv[1:2])
+
+    if args.command == "check":
+        check()
+    elif args.command == "status":
+        status()
+    else:
+        run_pipeline(args.command, sys.argv[2:])
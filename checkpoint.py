@@ -0,0 +1,76 @@
+"""
+分块断点续算
+
+长时间的循环按编号分块执行, 每块的部分结果保存为chunk_{i}.npz, 重启时跳过已完成的块,
+全部完成后由调用方合并结果并删除断点文件夹
+"""
+
+import os
+import json
+import shutil
+
+import numpy as np
+
+
+def prepare_chunk_dir(chunk_dir, key):
+    """
+    准备断点文件夹, key与已有断点不一致时(输入数据变化)清空旧断点
+
+    Input:
+        chunk_dir: 断点文件夹
+        key: 描述输入数据的可JSON序列化字典, 如建筑数量, 栅格大小
+    """
+    key_file = os.path.join(chunk_dir, "chunks.json")
+    if os.path.exists(key_file):
+        if json.load(open(key_file)) == json.loads(json.dumps(key)):
+            return
+        print("checkpoint key changed, removing:", chunk_dir)
+        shutil.rmtree(chunk_dir)
+    os.makedirs(chunk_dir, exist_ok=True)
+    with open(key_file, "w") as f:
+        json.dump(key, f)
+
+
+def chunk_file(chunk_dir, i):
+    return os.path.join(chunk_dir, f"chunk_{i:05d}.npz")
+
+
+def run_chunks(chunk_dir, chunks, process, key):
+    """
+    依次处理各块, 已保存的块直接读取
+
+    Input:
+        chunk_dir: 断点文件夹
+        chunks: 块的列表, 如建筑下标范围或tif编号
+        process: process(chunk) -> {名称: 数组}, 一个块的部分结果
+        key: 见prepare_chunk_dir
+
+    Output:
+        results: 与chunks顺序一致的部分结果列表
+    """
+    prepare_chunk_dir(chunk_dir, key)
+    results = []
+    done = 0
+    for i, chunk in enumerate(chunks):
+        file = chunk_file(chunk_dir, i)
+        if os.path.exists(file):
+            done += 1
+        else:
+            result = process(chunk)
+            # 先写临时文件再改名, 中断时不会留下不完整的块
+            tmp_file = os.path.join(chunk_dir, f"chunk_{i:05d}.tmp.npz")
+            np.savez(tmp_file, **result)
+            os.replace(tmp_file, file)
+        with np.load(file) as data:
+            results.append({name: data[name] for name in data.files})
+    if done:
+        print(f"resumed {done}/{len(chunks)} chunks from checkpoint:", chunk_dir)
+    return results
+
+
+def remove_chunks(chunk_dir):
+    """
+    结果合并保存后删除断点文件夹
+    """
+    if os.path.exists(chunk_dir):
+        shutil.rmtree(chunk_dir)
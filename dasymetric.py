@@ -0,0 +1,171 @@
+"""
+人口的分区密度(dasymetric)分配
+
+把栅格像元或区域的人口按建筑体积(面积 × 高度)分配到其中的建筑,
+权重用稀疏矩阵(像元/区域 × 建筑)计算, 再汇总得到区域的建筑级人口指标。
+高度为NaN或不大于0(MS数据中未知高度为-1)的建筑视为缺少高度
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+
+
+def building_volume(table):
+    """
+    建筑体积, 缺少高度的建筑用所在区域有高度建筑的面积加权平均高度,
+    区域内都没有高度时体积为0(分配时按面积)
+    """
+    n = len(table.geoids)
+    code = np.asarray(table.geoid_code)
+    area = np.asarray(table.area)
+    height = np.asarray(table.height, dtype=np.float64)
+    valid = np.isfinite(height) & (height > 0)
+    volume = np.where(valid, area * np.where(valid, height, 0), 0)
+    area_sum = np.bincount(code, weights=np.where(valid, area, 0), minlength=n)
+    volume_sum = np.bincount(code, weights=volume, minlength=n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean_height = np.where(area_sum > 0, volume_sum / area_sum, 0)
+    return np.where(valid, volume, area * mean_height[code])
+
+
+def allocation_matrix(zone_idx, building_idx, volume, area, n_zones, n_buildings):
+    """
+    构建按行归一化的分配矩阵
+
+    Input:
+        zone_idx, building_idx: 像元/区域与建筑的对应关系(可重复, 如建筑跨多个像元)
+        volume: 每对对应关系的建筑体积权重, NaN和负数按0处理
+        area: 每对对应关系的建筑面积权重, 区域内建筑体积全为0(无高度)时使用
+        n_zones, n_buildings: 矩阵大小
+
+    Output:
+        matrix: (n_zones, n_buildings)的csr矩阵, 有建筑的行之和为1
+    """
+    shape = (n_zones, n_buildings)
+    volume = np.nan_to_num(np.asarray(volume, dtype=np.float64)).clip(min=0)
+    by_volume = sp.csr_matrix((volume, (zone_idx, building_idx)), shape=shape)
+    by_area = sp.csr_matrix((area, (zone_idx, building_idx)), shape=shape)
+    volume_sum = np.asarray(by_volume.sum(axis=1)).ravel()
+    area_sum = np.asarray(by_area.sum(axis=1)).ravel()
+
+    with np.errstate(divide="ignore"):
+        volume_scale = np.where(volume_sum > 0, 1 / volume_sum, 0)
+        area_scale = np.where((volume_sum == 0) & (area_sum > 0), 1 / area_sum, 0)
+    return sp.diags(volume_scale) @ by_volume + sp.diags(area_scale) @ by_area
+
+
+def allocate(zone_pop, matrix):
+    """
+    按分配矩阵把人口分配到建筑
+
+    Output:
+        building_pop: 每个建筑的人口
+        allocated: 成功分配的人口比例, 没有建筑的像元/区域的人口无法分配
+    """
+    zone_pop = np.nan_to_num(np.asarray(zone_pop, dtype=np.float64)).clip(min=0)
+    building_pop = matrix.T @ zone_pop
+    assert (building_pop >= 0).all(), "negative building population"
+    total = zone_pop.sum()
+    return building_pop, (building_pop.sum() / total if total else 1.0)
+
+
+def allocate_from_regions(region_pop, table):
+    """
+    把区域(census tract)人口按体积分配到区域内的建筑
+
+    Input:
+        region_pop: 与table.geoids对齐的区域人口
+        table: 已计算area的BuildingTable
+    """
+    n = len(table)
+    matrix = allocation_matrix(
+        np.asarray(table.geoid_code),
+        np.arange(n),
+        building_volume(table),
+        np.asarray(table.area),
+        len(table.geoids),
+        n,
+    )
+    return allocate(region_pop, matrix)
+
+
+def allocate_from_pixels(pop, transform, table, geometry):
+    """
+    把人口栅格的像元人口按落在像元内的建筑体积分配到建筑
+
+    Input:
+        pop: (height, width)的人口栅格
+        transform: 人口栅格的仿射变换
+        table: 已计算area的BuildingTable
+        geometry: 与人口栅格同一坐标系的建筑几何
+    """
+    from coverage import coverage_pairs
+
+    building_idx, cell_idx, fraction = coverage_pairs(geometry, transform, pop.shape)
+    matrix = allocation_matrix(
+        cell_idx,
+        building_idx,
+        building_volume(table)[building_idx] * fraction,
+        np.asarray(table.area)[building_idx] * fraction,
+        pop.size,
+        len(table),
+    )
+    return allocate(pop.ravel(), matrix)
+
+
+def region_aggregates(building_pop, table):
+    """
+    按GEOID汇总建筑级人口
+
+    Output:
+        DataFrame, 列为GEOID, pop_building_sum, pop_building_mean, pop_building_max,
+        pop_per_volume(人口/建筑体积), pop_weighted_density(按人口加权的建筑人口密度, 人/平方米)
+    """
+    n = len(table.geoids)
+    code = np.asarray(table.geoid_code)
+    area = np.asarray(table.area)
+    volume = building_volume(table)
+    count = np.bincount(code, minlength=n)
+    pop_sum = np.bincount(code, weights=building_pop, minlength=n)
+    pop_max = np.zeros(n)
+    np.maximum.at(pop_max, code, building_pop)
+    volume_sum = np.bincount(code, weights=volume, minlength=n)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        density = np.where(area > 0, building_pop / area, 0)
+        weighted = np.bincount(code, weights=building_pop * density, minlength=n)
+        return pd.DataFrame(
+            {
+                "GEOID": table.geoids,
+                "pop_building_sum": pop_sum,
+                "pop_building_mean": np.where(count > 0, pop_sum / count, 0),
+                "pop_building_max": pop_max,
+                "pop_per_volume": np.where(volume_sum > 0, pop_sum / volume_sum, 0),
+                "pop_weighted_density": np.where(pop_sum > 0, weighted / pop_sum, 0),
+            }
+        )
+
+
+def read_raster_window(raster, bounds):
+    """
+    读取栅格中覆盖bounds的窗口
+
+    Output:
+        data: 窗口内的栅格值, 无效值(nodata或负数)置为0
+        transform: 窗口的仿射变换
+    """
+    from rasterio.windows import Window
+
+    inverse = ~raster.transform
+    col0, row0 = inverse * (bounds[0], bounds[3])
+    col1, row1 = inverse * (bounds[2], bounds[1])
+    col0, row0 = max(int(np.floor(col0)), 0), max(int(np.floor(row0)), 0)
+    col1 = min(int(np.ceil(col1)), raster.width)
+    row1 = min(int(np.ceil(row1)), raster.height)
+    window = Window(col0, row0, max(col1 - col0, 0), max(row1 - row0, 0))
+
+    data = raster.read(1, window=window).astype(np.float64)
+    if raster.nodata is not None:
+        data[data == raster.nodata] = 0
+    data[~np.isfinite(data) | (data < 0)] = 0
+    return data, raster.window_transform(window)
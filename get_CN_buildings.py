@@ -5,25 +5,18 @@ import warnings
 import json
 
 import numpy as np
-import pandas as pd
-import geopandas as gpd
-import folium
-import osmnx as ox
-import rasterio
-from rasterio.mask import mask
-from shapely.geometry import Polygon
-from pyproj import Geod
-from sklearn.preprocessing import StandardScaler
+
+from utils import standardize
 
 warnings.filterwarnings("ignore")
-scaler = StandardScaler()
-geod = Geod(ellps="WGS84")
 
 
 def get_gdf_region(city):
     """
     获取区域的GeoDataFrame
     """
+    import geopandas as gpd
+
     os.makedirs(f"./data/data_{city}", exist_ok=True)
 
     assert os.path.exists(
@@ -46,6 +39,15 @@ def get_footprint_from_osmnx(gdf_region):
     Output:
         gdf_building: 建筑物的GeoDataFrame
     """
+    import geopandas as gpd
+    import osmnx as ox
+
+    # 断点续算依赖建筑的顺序, 已下载的建筑直接读取
+    buildings_file = f"./data/data_{args.city}/buildings.geojson"
+    if os.path.exists(buildings_file):
+        print("buildings file exists:", buildings_file)
+        return gpd.read_file(buildings_file)
+
     tags = {"building": True}
     bounds = gdf_region.total_bounds
     bbox = [bounds[3], bounds[1], bounds[2], bounds[0]]
@@ -66,7 +68,7 @@ def get_footprint_from_osmnx(gdf_region):
     gdf_building = gdf_building.drop("type", axis=1)
     gdf_building = gdf_building.reset_index()
 
-    gdf_building.to_file(f"./data/data_{args.city}/buildings.geojson", driver="GeoJSON")
+    gdf_building.to_file(buildings_file, driver="GeoJSON")
 
     return gdf_building
 
@@ -116,6 +118,8 @@ def visualize_region(gdf_region, result_gdf):
         gdf_region: 区域的GeoDataFrame
         result_gdf: 区域的建筑数据的GeoDataFrame
     """
+    import folium
+
     m = folium.Map(
         location=[
             gdf_region["geometry"][0].centroid.y,
@@ -140,40 +144,80 @@ def get_CN_building(gdf_region):
     """
     获得区域建筑信息
     """
+    import geopandas as gpd
+    import rasterio
+    import shapely
+    from shapely.geometry import Polygon
+
+    import incremental
+    import parallel
+    from building_table import BuildingTable
+    from checkpoint import run_chunks, remove_chunks
+
     gdf_building = get_footprint_from_osmnx(gdf_region)
     tifs = download_height_tifs(gdf_region)
-    gdfs = []
-    for X, Y in zip(tifs[0].flatten(), tifs[1].flatten()):
+
+    def process(tif):
+        X, Y = tif
         print(f"loading CNBH10m_X{X}Y{Y}.tif")
-        chbn = rasterio.open(f"./data/data_CNBH/CNBH10m_X{X}Y{Y}.tif")
+        tif_file = f"./data/data_CNBH/CNBH10m_X{X}Y{Y}.tif"
+        chbn = rasterio.open(tif_file)
         chbn_polygon = Polygon.from_bounds(*(chbn.bounds))
-        footprints = gdf_building.to_crs(chbn.crs)
-        gdf = footprints[footprints["geometry"].intersects(chbn_polygon)]
-        gdf["height"] = gdf["geometry"].apply(
-            lambda x: np.max(np.nan_to_num(mask(chbn, [x], crop=True)[0]))
+        footprints = gdf_building["geometry"].to_crs(chbn.crs)
+        index = np.flatnonzero(footprints.intersects(chbn_polygon).values)
+        if index.size == 0:
+            return {"index": index, "height": np.zeros(0)}
+        # 按空间分片, 每个进程各自打开tif读取轮廓内的最大高度
+        geometry = footprints.values[index]
+        shards = parallel.spatial_shards(
+            shapely.bounds(geometry), max(args.workers, 1) * 4
+        )
+        results = parallel.map_shards(
+            parallel.raster_max_task,
+            parallel.ragged_arrays(geometry),
+            shards,
+            args.workers,
+            raster_path=tif_file,
         )
-        gdf["height"] = gdf["height"].astype(float)
-        gdfs.append(gdf)
-    gdf = pd.concat(gdfs)
+        height = parallel.scatter(results, shards, index.size, "height")
+        return {"index": index, "height": height}
+
+    # 每个tif一块, 保存与该tif相交的建筑下标和高度, 重启时跳过已完成的tif
+    tifs = [(int(X), int(Y)) for X, Y in zip(tifs[0].flatten(), tifs[1].flatten())]
+    chunk_dir = f"./data/data_{args.city}/height_chunks"
+    key = {
+        "buildings": gdf_building.shape[0],
+        "bounds": [float(x) for x in gdf_building.total_bounds],
+        "sha256": incremental.geometry_hash(gdf_building["geometry"].values),
+        "tifs": tifs,
+    }
+    results = run_chunks(chunk_dir, tifs, process, key)
+    gdf = gdf_building.iloc[np.concatenate([r["index"] for r in results])]
+    gdf["height"] = np.concatenate([r["height"] for r in results])
     gdf = gdf[gdf["height"] > 0]
-    gdf = gdf.to_crs("EPSG:4326")
     gdf = gpd.sjoin(
         gdf, gdf_region[["GEOID", "geometry"]], predicate="within", how="inner"
     )
 
     visualize_region(gdf_region, gdf)
 
-    result_gdf = gdf[["height", "GEOID", "geometry"]]
+    result_table = BuildingTable.from_geometries(
+        gdf["geometry"].values, gdf["height"].values, gdf["GEOID"].values
+    )
 
-    print("building nums =", result_gdf.shape[0])
+    print("building nums =", len(result_table))
+    remove_chunks(chunk_dir)
 
-    return result_gdf
+    return result_table
 
 
 def get_pop(gdf_region):
     """
     获得人口数据
     """
+    import rasterio
+    from rasterio.mask import mask
+
     if not os.path.exists("./data/data_worldpop"):
         os.mkdir("./data/data_worldpop")
         world_pop_dir = "./data/data_worldpop/chn_ppp_2020_UNadj.tif"
@@ -192,47 +236,40 @@ def get_pop(gdf_region):
     return gdf_region
 
 
-def get_building_feature(gdf_region, result_gdf):
+def get_building_feature(gdf_region, result_table):
     """
     计算区域统计特征到gdf_region中
     """
+    result_table.compute_features(args.workers)
+    result_gdf_agg = result_table.aggregate()
+    gdf_region = gdf_region.merge(result_gdf_agg, on="GEOID", how="left")
+    gdf_region = gdf_region.fillna(0)
+    gdf_region["building_density"] = gdf_region["area_sum"] / gdf_region["ALAND"]
+    gdf_region["plot_ratio"] = gdf_region["volume_sum"] / gdf_region["ALAND"]
+    return gdf_region
 
-    def calculate_ERI(polygon):
-        polygon_area = polygon.area
-        min_rect = polygon.minimum_rotated_rectangle
-        rect_area = min_rect.area
-        scale_factor = polygon_area / rect_area
 
-        min_rect = polygon.minimum_rotated_rectangle
-        ear_perimeter = scale_factor * min_rect.length
-        polygon_perimeter = polygon.length
+def get_building_population(gdf_region, result_table):
+    """
+    把WorldPop像元人口按建筑体积分配到像元内的建筑, 并汇总区域的建筑级人口指标
+    """
+    import rasterio
 
-        ERI = ear_perimeter / polygon_perimeter
-        return ERI
+    import dasymetric
 
-    result_gdf["complexity"] = result_gdf["geometry"].apply(calculate_ERI)
-    result_gdf["area"] = result_gdf["geometry"].apply(
-        lambda x: abs(geod.geometry_area_perimeter(x)[0])
-    )
-    result_gdf["volume"] = result_gdf["area"] * result_gdf["height"]
-    result_gdf_agg = (
-        result_gdf.groupby("GEOID")
-        .agg(
-            {
-                "area": ["mean", "sum"],
-                "height": "mean",
-                "volume": "sum",
-                "complexity": "mean",
-            }
-        )
-        .reset_index()
+    world_pop = rasterio.open("./data/data_worldpop/chn_ppp_2020_UNadj.tif")
+    geometry = result_table.to_geodataframe().to_crs(world_pop.crs)["geometry"]
+    pop, transform = dasymetric.read_raster_window(world_pop, geometry.total_bounds)
+    building_pop, allocated = dasymetric.allocate_from_pixels(
+        pop, transform, result_table, geometry.values
     )
-    result_gdf_agg.columns = ["_".join(col) for col in result_gdf_agg.columns.values]
-    result_gdf_agg = result_gdf_agg.rename(columns={"GEOID_": "GEOID"})
-    gdf_region = gdf_region.merge(result_gdf_agg, on="GEOID", how="left")
-    gdf_region = gdf_region.fillna(0)
-    gdf_region["building_density"] = gdf_region["area_sum"] / gdf_region["ALAND"]
-    gdf_region["plot_ratio"] = gdf_region["volume_sum"] / gdf_region["ALAND"]
+    print(f"population allocated to buildings: {allocated:.2%}")
+    result_table.population = building_pop
+
+    result_pop_agg = dasymetric.region_aggregates(building_pop, result_table)
+    gdf_region = gdf_region.merge(result_pop_agg, on="GEOID", how="left")
+    columns = result_pop_agg.columns[1:]
+    gdf_region[columns] = gdf_region[columns].fillna(0)
     return gdf_region
 
 
@@ -252,7 +289,7 @@ def dump_region2info(gdf_region):
             "plot_ratio",
         ]
     ]
-    gdf_region_normal.iloc[:, 1:] = scaler.fit_transform(gdf_region_normal.iloc[:, 1:])
+    gdf_region_normal.iloc[:, 1:] = standardize(gdf_region_normal.iloc[:, 1:].values)
 
     region2info = {
         gdf_region["GEOID"].iloc[i]: {
@@ -263,6 +300,10 @@ def dump_region2info(gdf_region):
             "complexity_mean": gdf_region["complexity_mean"].iloc[i],
             "building_density": gdf_region["building_density"].iloc[i],
             "plot_ratio": gdf_region["plot_ratio"].iloc[i],
+            "pop_building_mean": gdf_region["pop_building_mean"].iloc[i],
+            "pop_building_max": gdf_region["pop_building_max"].iloc[i],
+            "pop_per_volume": gdf_region["pop_per_volume"].iloc[i],
+            "pop_weighted_density": gdf_region["pop_weighted_density"].iloc[i],
             "feature": gdf_region_normal.iloc[i, 1:].values.tolist(),
         }
         for i in range(gdf_region_normal.shape[0])
@@ -275,6 +316,8 @@ def dump_region2info(gdf_region):
 
 
 def main(city):
+    from building_query import save_building_index
+
     # 读取区域的GeoDataFrame
     gdf_region = get_gdf_region(city)
 
@@ -282,20 +325,39 @@ def main(city):
     gdf_region = get_pop(gdf_region)
 
     # 获取区域的建筑数据
-    result_gdf = get_CN_building(gdf_region)  # 包含可视化代码
+    result_table = get_CN_building(gdf_region)  # 包含可视化代码
 
     # 计算区域的建筑密度和容积率
-    gdf_region = get_building_feature(gdf_region, result_gdf)
+    gdf_region = get_building_feature(gdf_region, result_table)
+
+    # 把人口分配到建筑
+    gdf_region = get_building_population(gdf_region, result_table)
 
     # 保存数据
     dump_region2info(gdf_region)
 
+    # 保存建筑空间索引, 供building_query.py按需查询
+    save_building_index(result_table, f"./data/data_{city}/building_index")
+
     return gdf_region
 
 
+def add_arguments(parser):
+    """
+    添加命令行参数, 供本脚本和buildings.py的cn子命令共用
+    """
+    parser.add_argument("--city", type=str, default="bj", choices=["bj", "jn", "sz"])
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes for the per-building stages",
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("--city", type=str, default="bj", choices=["bj", "jn", "sz"])
+    add_arguments(parser)
     args = parser.parse_args()
 
     gdf_region = main(args.city)
@@ -5,18 +5,32 @@ import subprocess
 import argparse
 import warnings
 import urllib.request
+import gzip
 
-from shapely.geometry import shape
+import numpy as np
 import pandas as pd
-import geopandas as gpd
-import mercantile
-import folium
-from pyproj import Geod
-from sklearn.preprocessing import StandardScaler
+
+from utils import standardize
 
 warnings.filterwarnings("ignore")
-scaler = StandardScaler()
-geod = Geod(ellps="WGS84")
+
+# MS建筑数据文件的quadkey层级
+MS_ZOOM = 9
+MS_LINKS = (
+    "https://minedbuildings.blob.core.windows.net/global-buildings/dataset-links.csv"
+)
+# --refresh时未受影响的区域从region2info_building.json沿用的列
+REGION_COLUMNS = [
+    "area_mean",
+    "height_mean",
+    "complexity_mean",
+    "building_density",
+    "plot_ratio",
+    "pop_building_mean",
+    "pop_building_max",
+    "pop_per_volume",
+    "pop_weighted_density",
+]
 
 
 def download_city(state_id, year):
@@ -45,6 +59,7 @@ def get_gdf_region(city):
     Output:
         gdf_region: 区域的GeoDataFrame, 包含区域的geojson数据和其他Census Tract数据
     """
+    import geopandas as gpd
 
     area_id = json.load(open(f"./data/data_{city}/regs.json"))
     state_id = {a[:2] for a in area_id}
@@ -109,6 +124,8 @@ def visualize_region(gdf_region, result_gdf):
         gdf_region: 区域的GeoDataFrame
         result_gdf: 区域的建筑数据的GeoDataFrame
     """
+    import folium
+
     m = folium.Map(location=[gdf_region["INTPTLAT"][0], gdf_region["INTPTLON"][0]])
     geojson_data = gdf_region.to_json()
     folium.GeoJson(
@@ -135,6 +152,8 @@ def get_nyc_building(gdf_region):
     """
     获得纽约市的建筑数据，因为MS_building缺少纽约市的数据
     """
+    from shapely.geometry import shape
+
     if not os.path.exists("./data/data_nyc/building.geojson"):
         subprocess.run(
             [
@@ -148,97 +167,311 @@ def get_nyc_building(gdf_region):
 
     building_json = json.load(open("./data/data_nyc/building.geojson", "r"))
     print("building json file data loaded!")
-    gdf_building = pd.DataFrame(building_json["features"])
-    gdf_building["geometry"] = gdf_building["geometry"].apply(shape)
-    gdf_building = gpd.GeoDataFrame(gdf_building, crs="4326")
-    gdf_building["type"] = gdf_building["properties"].apply(lambda x: x["feat_code"])
-    gdf_building = gdf_building[gdf_building["type"] == "2100"]
-    result_gdf = gpd.sjoin(gdf_building, gdf_region, predicate="within", how="inner")
+    features = [
+        f for f in building_json["features"] if f["properties"]["feat_code"] == "2100"
+    ]
+    del building_json
+    # 只保留几何和高度, 不再携带properties字典
+    geometry = np.array([shape(f["geometry"]) for f in features], dtype=object)
+    height = pd.Series([f["properties"]["heightroof"] for f in features])
+    height = height.fillna(0).astype(float).to_numpy() * 0.3048
+    del features
+
+    result_table, grid_stats = join_building_feature(gdf_region, geometry, height)
+    visualize_region(gdf_region, result_table.to_geodataframe())
+    print("building nums =", len(result_table))
 
-    visualize_region(gdf_region, result_gdf)
+    return result_table, grid_stats
 
-    result_gdf["height"] = result_gdf["properties"].apply(lambda x: x["heightroof"])
-    result_gdf["height"] = result_gdf["height"].fillna(0)
-    result_gdf["height"] = result_gdf["height"].astype(float) * 0.3048
-    result_gdf = result_gdf[["height", "GEOID", "geometry"]]
-    print("building nums =", result_gdf.shape[0])
 
-    return result_gdf
+def join_building_table(gdf_region, geometry, height, area=None, complexity=None):
+    """
+    将建筑与区域做空间连接(within), 得到紧凑的建筑表
 
+    Input:
+        gdf_region: 区域的GeoDataFrame
+        geometry: 建筑几何数组(EPSG:4326)
+        height: 建筑高度数组
+        area, complexity: 已计算的建筑面积和ERI, 随连接结果一起保留
 
-def get_MS_building(gdf_region):
+    Output:
+        result_table: BuildingTable, 与gpd.sjoin(predicate="within", how="inner")的结果一致
     """
-    获得MS_building数据集中的建筑数据
+    from building_table import BuildingTable
+
+    building_idx, region_idx = gdf_region.sindex.query(geometry, predicate="within")
+    table = BuildingTable.from_geometries(
+        geometry[building_idx],
+        height[building_idx],
+        gdf_region["GEOID"].to_numpy()[region_idx],
+    )
+    if area is not None:
+        table.area = area[building_idx]
+        table.complexity = complexity[building_idx]
+    return table
+
+
+def join_building_feature(gdf_region, geometry, height):
     """
-    min_lon, min_lat, max_lon, max_lat = gdf_region["geometry"].total_bounds
-    tiles = list(mercantile.tiles(min_lon, min_lat, max_lon, max_lat, zooms=9))
-    quad_keys = list(set([int(mercantile.quadkey(tile)) for tile in tiles]))
-    print("quad_keys:", quad_keys)
-    # Download the data
-    df = pd.read_csv(
-        "https://minedbuildings.blob.core.windows.net/global-buildings/dataset-links.csv"
+    与区域连接并计算建筑面积和ERI; --agg grid时先用连接之前的全部建筑计算网格统计量,
+    使grid_stats.npz包含跨tract边界和tract之外的建筑, 可用于任意区域
+
+    Output:
+        result_table: 连接后的BuildingTable
+        grid_stats: 网格统计量, --agg tract时为None
+    """
+    from building_table import BuildingTable
+
+    if args.agg != "grid":
+        result_table = join_building_table(gdf_region, geometry, height)
+        result_table.compute_features(args.workers)
+        return result_table, None
+
+    import grid_agg
+
+    # 未与区域连接的全部建筑, GEOID留空
+    parsed = BuildingTable.from_geometries(geometry, height, np.full(len(height), ""))
+    parsed.compute_features(args.workers)
+    grid_stats = grid_agg.cell_statistics(parsed, args.grid_zoom)
+    result_table = join_building_table(
+        gdf_region, geometry, height, parsed.area, parsed.complexity
     )
-    print("df url loaded!")
-    df_list = []
+    return result_table, grid_stats
 
-    for _, row in df.iterrows():
-        if int(row.QuadKey) in quad_keys:
-            url = row["Url"]
-            df = pd.read_json(url, lines=True)
-            print(f"get {int(row.QuadKey)} finished!")
-            df_list.append(df)
 
-    df = pd.concat(df_list, ignore_index=True)
-    df["geometry"] = df["geometry"].apply(shape)
-    gdf_building = gpd.GeoDataFrame(df, crs="4326")
-    result_gdf = gpd.sjoin(gdf_building, gdf_region, predicate="within", how="inner")
+def read_building_lines(url):
+    """
+    下载一个quadkey的建筑文件(每行一个GeoJSON Feature), 返回解压后的字节, url也可以是本地路径
+    """
+    from incremental import open_source
+
+    data = open_source(url)
+    if url.endswith(".gz"):
+        data = gzip.decompress(data)
+    return data
+
+
+def parse_building_lines(data, workers=1, keep=None):
+    """
+    解析GeoJSON行, workers大于1时多进程解析, 行数据放在共享内存中
+
+    Input:
+        keep: tile_plan.plan_tiles的保留网格{"keep_keys", "keep_zooms"}, 不在其中的建筑跳过
+
+    Output:
+        geometry: 建筑几何数组
+        height: 建筑高度数组
+        skipped: 跳过的建筑数
+    """
+    import parallel
+
+    buffer = np.frombuffer(data, dtype=np.uint8)
+    newline = np.flatnonzero(buffer == ord("\n"))
+    starts = np.concatenate([[0], newline + 1])
+    ends = np.concatenate([newline, [len(buffer)]])
+    nonempty = ends - starts > 1
+    starts, ends = starts[nonempty], ends[nonempty]
+    shards = np.array_split(np.arange(len(starts)), max(workers, 1) * 4)
+    shards = [shard for shard in shards if len(shard)]
+    if not shards:
+        return np.array([], dtype=object), np.array([], dtype=np.float64), 0
+
+    arrays = {"lines": buffer, "line_starts": starts, "line_ends": ends}
+    if keep is not None:
+        arrays.update(keep)
+    results = parallel.map_shards(parallel.parse_task, arrays, shards, workers)
+    geometry = np.concatenate([parallel.result_geometry(r) for r in results])
+    height = np.concatenate([r["height"] for r in results])
+    skipped = int(sum(r["skipped"][0] for r in results))
+    return geometry, height, skipped
+
+
+def get_MS_building(gdf_region):
+    """
+    获得MS_building数据集中的建筑数据
 
-    visualize_region(gdf_region, result_gdf)
+    每个quadkey文件为一个分区, 连接到区域并计算面积和ERI后保存到partitions文件夹, 版本记录在manifest.json中;
+    --refresh时只重新处理版本(ETag, Last-Modified, 大小, 内容hash)变化的分区
 
-    result_gdf["height"] = result_gdf["properties"].apply(lambda x: x["height"])
-    result_gdf = result_gdf[["height", "GEOID", "geometry"]]
-    print("building nums =", result_gdf.shape[0])
+    Output:
+        result_table: 所有分区拼接成的BuildingTable
+        grid_stats: --agg grid时由连接之前的全部建筑计算的网格统计量, 否则为None
+        affected: --refresh时建筑有变化的GEOID集合, 全部重算时为None
+        manifest: 更新后的manifest, 在结果保存后由main写入
+    """
+    import shutil
+
+    import shapely
+
+    import incremental
+    import tile_plan
+    from building_table import BuildingTable
+
+    folder = f"./data/data_{args.city}/"
+    manifest = incremental.load_manifest(folder + "manifest.json")
+    # 区域变化或之前没有完整运行过时全部重新处理
+    refresh = args.refresh and manifest["key"] == incremental.region_key(gdf_region)
+    if args.refresh and not refresh:
+        print("regions changed or no manifest, rebuilding all partitions")
+    if not refresh:
+        manifest = {"key": None, "partitions": {}}
+    # 上次刷新中断时已处理但还未保存结果的GEOID
+    affected = set(manifest.get("pending", []))
+
+    # 按tract几何的并集逐层细分quadkey, 只下载与tract相交的9级文件
+    region = shapely.union_all(gdf_region["geometry"].values)
+    tiles, keep_keys, keep_zooms = tile_plan.plan_tiles(region, MS_ZOOM, args.tile_zoom)
+    bbox_tiles = tile_plan.plan_tiles(
+        shapely.box(*gdf_region["geometry"].total_bounds), MS_ZOOM, MS_ZOOM
+    )[0]
+    quad_keys = tile_plan.ms_quadkey(tiles, MS_ZOOM)
+    print("quad_keys:", list(quad_keys))
+    # Download the data
+    df = pd.read_csv(args.links)
+    print("df url loaded!")
+    rows = df[df["QuadKey"].astype(np.int64).isin(quad_keys)]
+    print(
+        f"tiles: {len(tiles)} of {len(bbox_tiles)} in bbox, "
+        f"download: {tile_plan.download_size(rows) / (1 << 20):.1f}MB, "
+        f"tile area kept: {tile_plan.covered_fraction(keep_keys, keep_zooms, MS_ZOOM):.1%}"
+    )
+    keep = {"keep_keys": keep_keys, "keep_zooms": keep_zooms}
+    partitions = {}
+
+    grid_stats = {}
+
+    def partition_geoids(table):
+        return set(table.geoids[np.unique(table.geoid_code)])
+
+    def load_partition(name, partition_dir):
+        partitions[name] = BuildingTable.load(partition_dir, mmap=False)
+        if args.agg == "grid":
+            with np.load(partition_dir + "/grid_stats.npz") as data:
+                grid_stats[name] = {k: data[k] for k in data.files if k != "zoom"}
+
+    def has_grid_stats(partition_dir):
+        grid_file = partition_dir + "/grid_stats.npz"
+        if not os.path.exists(grid_file):
+            return False
+        with np.load(grid_file) as data:
+            return int(data["zoom"]) == args.grid_zoom
+
+    for _, row in rows.iterrows():
+        url = row["Url"]
+        name = f"{row.get('Location', 'MS')}_{int(row.QuadKey)}"
+        partition_dir = folder + f"partitions/{name}"
+        entry = manifest["partitions"].get(name)
+        exists = refresh and os.path.exists(partition_dir)
+        # --agg grid需要分区的网格统计量, 没有或层级不同时重新处理
+        if args.agg == "grid":
+            exists = exists and has_grid_stats(partition_dir)
+        version = incremental.source_version(url)
+        if exists and not incremental.version_changed(entry, version):
+            print(f"{name} unchanged")
+            load_partition(name, partition_dir)
+            continue
+
+        data = read_building_lines(url)
+        version["sha256"] = incremental.content_hash(data)
+        if exists and entry is not None and entry.get("sha256") == version["sha256"]:
+            print(f"{name} unchanged (same content)")
+            load_partition(name, partition_dir)
+        else:
+            # --agg grid时网格统计量包含tract之外的建筑, 不跳过任何建筑
+            geometry, height, skipped = parse_building_lines(
+                data, args.workers, None if args.agg == "grid" else keep
+            )
+            print(f"get {int(row.QuadKey)} finished! skipped {skipped} outside tracts")
+            table, stats = join_building_feature(gdf_region, geometry, height)
+            if exists:
+                affected |= partition_geoids(
+                    BuildingTable.load(partition_dir, mmap=False)
+                )
+            affected |= partition_geoids(table)
+            table.save(partition_dir)
+            if stats is not None:
+                np.savez(
+                    partition_dir + "/grid_stats.npz", zoom=args.grid_zoom, **stats
+                )
+                grid_stats[name] = stats
+            partitions[name] = table
+        manifest["partitions"][name] = {**version, "count": len(partitions[name])}
+        if refresh:
+            # 分区已更新, 记下受影响的GEOID, 中断后重新运行时仍会重算这些区域
+            manifest["pending"] = sorted(affected)
+            incremental.save_manifest(manifest, folder + "manifest.json")
+
+    # 删除不再需要的分区(规划变化或文件被移除)
+    if os.path.exists(folder + "partitions"):
+        for name in os.listdir(folder + "partitions"):
+            if name not in partitions:
+                partition_dir = folder + f"partitions/{name}"
+                if refresh:
+                    affected |= partition_geoids(
+                        BuildingTable.load(partition_dir, mmap=False)
+                    )
+                shutil.rmtree(partition_dir)
+    manifest["partitions"] = {name: manifest["partitions"][name] for name in partitions}
+
+    result_table = BuildingTable.concat(list(partitions.values()))
+    if not refresh or affected:
+        visualize_region(gdf_region, result_table.to_geodataframe())
+    print("building nums =", len(result_table))
+    if args.agg == "grid":
+        import grid_agg
+
+        grid_stats = grid_agg.merge([grid_stats[name] for name in partitions])
+    else:
+        grid_stats = None
 
-    return result_gdf
+    return result_table, grid_stats, (affected if refresh else None), manifest
 
 
-def get_building_feature(gdf_region, result_gdf):
+def save_partition_population(result_table, manifest):
     """
-    计算区域统计特征到gdf_region中
+    把建筑人口按分区保存, --refresh时未受影响的建筑沿用
     """
+    folder = f"./data/data_{args.city}/partitions/"
+    start = 0
+    for name, entry in manifest["partitions"].items():
+        end = start + entry["count"]
+        np.save(folder + f"{name}/population.npy", result_table.population[start:end])
+        start = end
 
-    def calculate_ERI(polygon):
-        polygon_area = polygon.area
-        min_rect = polygon.minimum_rotated_rectangle
-        rect_area = min_rect.area
-        if rect_area == 0:
-            return 1
-        scale_factor = polygon_area / rect_area
-        ear_perimeter = scale_factor * min_rect.length
-        polygon_perimeter = polygon.length
 
-        ERI = ear_perimeter / polygon_perimeter
-        return ERI
+def get_grid_feature(gdf_region, stats):
+    """
+    保存多尺度网格统计, 并按重叠面积把网格上的建筑指标近似到区域
+
+    Input:
+        stats: 与区域连接之前的全部建筑的网格统计量, 见join_building_feature
+
+    Output:
+        result_gdf_agg: 与BuildingTable.aggregate列一致的区域指标
+    """
+    import grid_agg
 
-    result_gdf["complexity"] = result_gdf["geometry"].apply(calculate_ERI)
-    result_gdf["area"] = result_gdf["geometry"].apply(
-        lambda x: abs(geod.geometry_area_perimeter(x)[0])
+    grid_agg.save_multiscale(
+        stats,
+        args.grid_zoom,
+        args.grid_coarse_zoom,
+        f"./data/data_{args.city}/grid_stats.npz",
     )
-    result_gdf["volume"] = result_gdf["area"] * result_gdf["height"]
-    result_gdf_agg = (
-        result_gdf.groupby("GEOID")
-        .agg(
-            {
-                "area": ["mean", "sum"],
-                "height": "mean",
-                "volume": "sum",
-                "complexity": "mean",
-            }
-        )
-        .reset_index()
+    result_gdf_agg = grid_agg.finalize(
+        grid_agg.map_to_regions(stats, gdf_region, args.grid_zoom)
     )
-    result_gdf_agg.columns = ["_".join(col) for col in result_gdf_agg.columns.values]
-    result_gdf_agg = result_gdf_agg.rename(columns={"GEOID_": "GEOID"})
+    columns = ["GEOID", "area_mean", "area_sum", "height_mean", "volume_sum"]
+    return result_gdf_agg[columns + ["complexity_mean"]]
+
+
+def get_building_feature(gdf_region, result_table, grid_stats=None):
+    """
+    计算区域统计特征到gdf_region中, --agg grid时由grid_stats近似
+    """
+    if args.agg == "grid":
+        result_gdf_agg = get_grid_feature(gdf_region, grid_stats)
+    else:
+        result_gdf_agg = result_table.aggregate()
     gdf_region = gdf_region.merge(result_gdf_agg, on="GEOID", how="left")
     gdf_region = gdf_region.fillna(0)
     gdf_region["building_density"] = gdf_region["area_sum"] / gdf_region["ALAND"]
@@ -246,6 +479,53 @@ def get_building_feature(gdf_region, result_gdf):
     return gdf_region
 
 
+def get_building_population(gdf_region, result_table):
+    """
+    把tract的pop_overall按建筑体积分配到建筑, 并汇总tract的建筑级人口指标
+    """
+    import dasymetric
+
+    region_pop = gdf_region.set_index("GEOID")["pop_overall"]
+    region_pop = pd.to_numeric(region_pop, errors="coerce")
+    region_pop = region_pop.reindex(result_table.geoids).to_numpy()
+    building_pop, allocated = dasymetric.allocate_from_regions(region_pop, result_table)
+    print(f"population allocated to buildings: {allocated:.2%}")
+    result_table.population = building_pop
+
+    result_pop_agg = dasymetric.region_aggregates(building_pop, result_table)
+    gdf_region = gdf_region.merge(result_pop_agg, on="GEOID", how="left")
+    columns = result_pop_agg.columns[1:]
+    gdf_region[columns] = gdf_region[columns].fillna(0)
+    return gdf_region
+
+
+def update_region_feature(gdf_region, result_table, affected):
+    """
+    --refresh时只重算affected中区域的建筑指标和人口指标, 其余区域沿用region2info_building.json中的值
+    """
+    region2info = json.load(open(f"./data/data_{args.city}/region2info_building.json"))
+    # 上次结果中没有的区域也需要计算
+    affected = set(affected) | (set(gdf_region["GEOID"]) - set(region2info))
+    is_affected = gdf_region["GEOID"].isin(affected).to_numpy()
+    print(f"recomputing {is_affected.sum()}/{len(gdf_region)} regions")
+
+    geoid = result_table.geoids[result_table.geoid_code]
+    idx = np.flatnonzero(np.isin(geoid, list(affected)))
+    sub_table = result_table.take(idx)
+    gdf_affected = get_building_feature(gdf_region[is_affected], sub_table)
+    gdf_affected = get_building_population(gdf_affected, sub_table)
+    result_table.population[idx] = sub_table.population
+
+    gdf_rest = gdf_region[~is_affected].copy()
+    for column in REGION_COLUMNS:
+        gdf_rest[column] = [region2info[g][column] for g in gdf_rest["GEOID"]]
+    # 按原来的区域顺序排列, 标准化后的feature与全部重算一致
+    order = pd.Index(pd.concat([gdf_affected, gdf_rest])["GEOID"]).get_indexer(
+        gdf_region["GEOID"]
+    )
+    return pd.concat([gdf_affected, gdf_rest]).iloc[order].reset_index(drop=True)
+
+
 def dump_region2info(gdf_region):
     """
     保存数据
@@ -264,7 +544,7 @@ def dump_region2info(gdf_region):
             "plot_ratio",
         ]
     ]
-    gdf_region_normal.iloc[:, 1:] = scaler.fit_transform(gdf_region_normal.iloc[:, 1:])
+    gdf_region_normal.iloc[:, 1:] = standardize(gdf_region_normal.iloc[:, 1:].values)
 
     region2info = {
         gdf_region["GEOID"].iloc[i]: {
@@ -277,6 +557,10 @@ def dump_region2info(gdf_region):
             "complexity_mean": gdf_region["complexity_mean"].iloc[i],
             "building_density": gdf_region["building_density"].iloc[i],
             "plot_ratio": gdf_region["plot_ratio"].iloc[i],
+            "pop_building_mean": gdf_region["pop_building_mean"].iloc[i],
+            "pop_building_max": gdf_region["pop_building_max"].iloc[i],
+            "pop_per_volume": gdf_region["pop_per_volume"].iloc[i],
+            "pop_weighted_density": gdf_region["pop_weighted_density"].iloc[i],
             "feature": gdf_region_normal.iloc[i, 1:].values.tolist(),
         }
         for i in range(gdf_region_normal.shape[0])
@@ -289,6 +573,9 @@ def dump_region2info(gdf_region):
 
 
 def main(city):
+    import incremental
+    from building_query import save_building_index
+
     # 获取区域的geojson数据
     gdf_region = get_gdf_region(city)
 
@@ -296,26 +583,95 @@ def main(city):
     gdf_region = get_statistics(gdf_region)
 
     # 获取区域的建筑数据
+    affected = manifest = None
     if city == "nyc":
-        result_gdf = get_nyc_building(gdf_region)  # 包含可视化代码
+        result_table, grid_stats = get_nyc_building(gdf_region)  # 包含可视化代码
+    else:
+        # 包含可视化代码
+        result_table, grid_stats, affected, manifest = get_MS_building(gdf_region)
+    if affected is not None and not affected:
+        print("no partition changed, outputs are up to date")
+        incremental.save_manifest(manifest, f"./data/data_{city}/manifest.json")
+        return gdf_region
+
+    if affected is not None and args.agg == "tract":
+        # 只重算建筑有变化的区域
+        gdf_region = update_region_feature(gdf_region, result_table, affected)
     else:
-        result_gdf = get_MS_building(gdf_region)  # 包含可视化代码
+        # 计算区域的建筑密度和容积率
+        gdf_region = get_building_feature(gdf_region, result_table, grid_stats)
 
-    # 计算区域的建筑密度和容积率
-    gdf_region = get_building_feature(gdf_region, result_gdf)
+        # 把人口分配到建筑
+        gdf_region = get_building_population(gdf_region, result_table)
 
     # 保存数据
     dump_region2info(gdf_region)
 
+    # 保存建筑空间索引, 供building_query.py按需查询
+    save_building_index(result_table, f"./data/data_{city}/building_index")
+
+    # 结果保存后再更新manifest, 中断时下次--refresh会重新处理
+    if manifest is not None:
+        save_partition_population(result_table, manifest)
+        manifest["key"] = incremental.region_key(gdf_region)
+        manifest["pending"] = []
+        incremental.save_manifest(manifest, f"./data/data_{city}/manifest.json")
+
     return gdf_region
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def add_arguments(parser):
+    """
+    添加命令行参数, 供本脚本和buildings.py的ms子命令共用
+    """
     parser.add_argument("--city", type=str, default="nyc", choices=["DC", "BM", "nyc"])
     parser.add_argument(
         "--year", "-y", type=int, default=2015, help="Year of the census tract data"
     )
+    parser.add_argument(
+        "--agg",
+        type=str,
+        default="tract",
+        choices=["tract", "grid"],
+        help="aggregate buildings by tract join or by quadkey grid",
+    )
+    parser.add_argument(
+        "--grid-zoom", type=int, default=18, help="finest quadkey level for --agg grid"
+    )
+    parser.add_argument(
+        "--grid-coarse-zoom",
+        type=int,
+        default=12,
+        help="coarsest quadkey level saved for --agg grid",
+    )
+    parser.add_argument(
+        "--tile-zoom",
+        type=int,
+        default=13,
+        help="finest quadkey level for planning the MS tile downloads",
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="re-ingest only the MS partitions whose version changed",
+    )
+    parser.add_argument(
+        "--links",
+        type=str,
+        default=MS_LINKS,
+        help="dataset-links.csv of the MS buildings, a URL or a local file",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes for the per-building stages",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
     args = parser.parse_args()
 
     gdf_region = main(args.city)
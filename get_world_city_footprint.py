@@ -5,21 +5,15 @@ import warnings
 import json
 from io import BytesIO
 
-import requests
-import numpy as np
-import geopandas as gpd
-import osmnx as ox
-import rasterio
-from rasterio.features import geometry_mask
-from pyproj import Geod
-import folium
-from tqdm import tqdm
-
 warnings.filterwarnings("ignore")
-geod = Geod(ellps="WGS84")
+
+# agg_cell_buildings_area_{city}.npy的计算方法, 记录在manifest中, 增量更新时不混用不同方法的结果
+RASTER_METHOD = "coverage"
 
 
 def download_city_bounds(city, bounds_file):
+    import osmnx as ox
+
     try:
         boundings = ox.geocode_to_gdf(city)
         boundings = boundings.to_crs("EPSG:4326")
@@ -36,6 +30,8 @@ def download_city_bounds(city, bounds_file):
 
 
 def download_one_city_building_footprint(city, bounds_gdf, buildings_file):
+    import osmnx as ox
+
     try:
         if city == None:
             raise Exception("city is None")
@@ -91,6 +87,8 @@ def visualize_city_footprint(bounds_gdf, buildings_gdf, visual_file):
         bounds_gdf: 区域的GeoDataFrame
         buildings_gdf: 区域的建筑数据的GeoDataFrame
     """
+    import folium
+
     if os.path.exists(visual_file):
         print("visual file exists:", visual_file)
         return
@@ -119,6 +117,34 @@ def visualize_city_footprint(bounds_gdf, buildings_gdf, visual_file):
     m.save(visual_file)
 
 
+def open_worldpop_raster(bounds_gdf, worldpop_file, save_tif=True, chunk_size=1024):
+    """
+    打开城市范围的WorldPop栅格, 本地没有时从WorldPop服务下载
+    """
+    import requests
+    import rasterio
+
+    base_url = "https://worldpop.arcgis.com/arcgis/rest/services/WorldPop_Total_Population_100m/ImageServer/exportImage?f=image&format=tiff&noData=0&"
+
+    if not os.path.exists(worldpop_file):
+        left, bottom, right, top = bounds_gdf.total_bounds
+        url = base_url + f"bbox={left},{bottom},{right},{top}"
+        response = requests.get(url, stream=True, timeout=100)
+        response.raise_for_status()
+        if save_tif:
+            # with open(
+            #     worldpop_file,
+            # ) as f:
+            #     for chunk in response.iter_content(chunk_size=chunk_size):
+            #         f.write(chunk)
+            pass
+        tiff_data = BytesIO(response.content)
+        return rasterio.open(tiff_data)
+
+    print("worldpop file exists:", worldpop_file)
+    return rasterio.open(worldpop_file)
+
+
 def download_worldpop_raster(
     city,
     bounds_gdf,
@@ -127,51 +153,70 @@ def download_worldpop_raster(
     buildings_meta_file,
     save_tif=True,
     chunk_size=1024,
+    chunk_buildings=50000,
+    workers=1,
 ):
+    import numpy as np
+    import shapely
+    from tqdm import tqdm
+
+    import incremental
+    import parallel
+    from checkpoint import run_chunks, remove_chunks
+
     if os.path.exists(buildings_meta_file):
         print("buildings_meta file exists:", buildings_meta_file)
         return
-    base_url = "https://worldpop.arcgis.com/arcgis/rest/services/WorldPop_Total_Population_100m/ImageServer/exportImage?f=image&format=tiff&noData=0&"
 
     try:
-        if not os.path.exists(worldpop_file):
-            left, bottom, right, top = bounds_gdf.total_bounds
-            url = base_url + f"bbox={left},{bottom},{right},{top}"
-            response = requests.get(url, stream=True, timeout=100)
-            response.raise_for_status()
-            if save_tif:
-                # with open(
-                #     worldpop_file,
-                # ) as f:
-                #     for chunk in response.iter_content(chunk_size=chunk_size):
-                #         f.write(chunk)
-                pass
-            tiff_data = BytesIO(response.content)
-            raster = rasterio.open(tiff_data)
-        else:
-            print("worldpop file exists:", worldpop_file)
-            raster = rasterio.open(worldpop_file)
-
+        raster = open_worldpop_raster(bounds_gdf, worldpop_file, save_tif, chunk_size)
         height, width = raster.height, raster.width
         raster_transform = raster.transform
-        buildings_meta = np.zeros((height, width), dtype=np.float32)
-        buildings_gdf["area"] = buildings_gdf["geometry"].apply(
-            lambda x: abs(geod.geometry_area_perimeter(x)[0])
-        )
-        buildings_gdf = buildings_gdf.to_crs(raster.crs)
-
-        for _, building in tqdm(buildings_gdf.iterrows(), total=buildings_gdf.shape[0]):
-            geom = [building.geometry]
-            mask_ = geometry_mask(
-                geom,
-                transform=raster_transform,
-                invert=True,
-                out_shape=(height, width),
+        buildings = buildings_gdf.to_crs(raster.crs)["geometry"].values
+        buildings_geo = buildings_gdf["geometry"].values
+
+        def process(chunk):
+            start, end = chunk
+            # 块内再按空间分片多进程计算, 按建筑落在每个栅格内的面积比例分配测地面积
+            arrays = parallel.ragged_arrays(buildings[start:end])
+            arrays.update(parallel.ragged_arrays(buildings_geo[start:end], "geo_"))
+            arrays["transform"] = np.array(raster_transform[:6])
+            arrays["shape"] = np.array([height, width])
+            shards = parallel.spatial_shards(
+                shapely.bounds(buildings[start:end]), max(workers, 1) * 4
             )
-            buildings_meta[mask_] += building.area
-
-        buildings_gdf.drop("area", axis=1, inplace=True)
-        buildings_gdf = buildings_gdf.to_crs("EPSG:4326")
+            results = parallel.map_shards(
+                parallel.coverage_task, arrays, shards, workers
+            )
+            block = np.zeros(height * width, dtype=np.float64)
+            for result in results:
+                block += np.bincount(
+                    result["cell"], weights=result["value"], minlength=block.size
+                )
+            index = np.flatnonzero(block)
+            return {"index": index, "value": block.ravel()[index]}
+
+        # 按建筑下标分块, 每块的部分和保存到断点文件夹, 重启时跳过已完成的块
+        n = len(buildings)
+        chunks = [
+            (i, min(i + chunk_buildings, n)) for i in range(0, n, chunk_buildings)
+        ]
+        chunk_dir = os.path.splitext(buildings_meta_file)[0] + "_chunks"
+        key = {
+            "method": RASTER_METHOD,
+            "buildings": n,
+            "bounds": [float(x) for x in buildings_gdf.total_bounds],
+            # 数量和范围相同的新版本建筑(如--refresh下载的OSM修改)不能沿用旧的断点
+            "sha256": incremental.geometry_hash(buildings_geo),
+            "raster": [height, width, *raster_transform[:6]],
+            "chunk_buildings": chunk_buildings,
+        }
+        results = run_chunks(chunk_dir, tqdm(chunks), process, key)
+
+        buildings_meta = np.zeros(height * width, dtype=np.float64)
+        for result in results:
+            buildings_meta[result["index"]] += result["value"]
+        buildings_meta = buildings_meta.reshape(height, width).astype(np.float32)
         print(
             "buildings_meta:",
             buildings_meta.shape,
@@ -179,6 +224,8 @@ def download_worldpop_raster(
             np.mean(buildings_meta),
         )
         np.save(buildings_meta_file, buildings_meta)
+        remove_chunks(chunk_dir)
+        save_raster_method(city, buildings_meta_file)
 
     except KeyboardInterrupt:
         sys.exit()
@@ -189,6 +236,64 @@ def download_worldpop_raster(
             f.write(str(e) + "\n")
 
 
+def compare_city_coverage(cities):
+    """
+    用覆盖率栅格化重新计算已有城市的栅格建筑面积, 与已有的
+    agg_cell_buildings_area_{city}.npy(geometry_mask结果)比较, 差异保存到coverage_diff.json。
+    manifest中记录的raster_method已经是覆盖率方法的城市没有可比较的旧结果, 跳过
+    """
+    import geopandas as gpd
+    import numpy as np
+    from pyproj import Geod
+
+    import incremental
+    from coverage import coverage_raster, coverage_diff
+
+    geod = Geod(ellps="WGS84")
+    report = {}
+    for key, cities_list in cities.items():
+        for city in cities_list:
+            folder = f"./data/bldg/{key}/"
+            bounds_file = folder + f"bounds_{city}.geojson"
+            buildings_file = folder + f"buildings_{city}.geojson"
+            worldpop_file = folder + f"worldpop_{city}.tif"
+            buildings_meta_file = folder + f"agg_cell_buildings_area_{city}.npy"
+            if not all(
+                os.path.exists(f)
+                for f in [bounds_file, buildings_file, buildings_meta_file]
+            ):
+                continue
+            manifest_file = folder + f"manifest_{city}.json"
+            method = incremental.load_manifest(manifest_file).get("raster_method")
+            if method == RASTER_METHOD:
+                print(f"{key}/{city}: raster already built by {method}, skipped")
+                continue
+
+            bounds_gdf = gpd.read_file(bounds_file)
+            buildings_gdf = gpd.read_file(buildings_file)
+            raster = open_worldpop_raster(bounds_gdf, worldpop_file)
+            area = [
+                abs(geod.geometry_area_perimeter(x)[0])
+                for x in buildings_gdf["geometry"].values
+            ]
+            new = coverage_raster(
+                buildings_gdf.to_crs(raster.crs)["geometry"].values,
+                area,
+                raster.transform,
+                (raster.height, raster.width),
+            )
+            old = np.load(buildings_meta_file)
+            if old.shape != new.shape:
+                print(f"{city}: raster shape changed {old.shape} -> {new.shape}")
+                continue
+            report[city] = coverage_diff(new, old)
+            print(f"{key}/{city}:", report[city])
+
+    with open("./data/bldg/coverage_diff.json", "w") as f:
+        json.dump(report, f, indent=4)
+    print("coverage_diff.json saved!")
+
+
 def check_city_footprint(cities):
     for key, cities_list in cities.items():
         count_bounds = 0
@@ -212,7 +317,247 @@ def check_city_footprint(cities):
         )
 
 
+def buildings_version(city, bounds_gdf, entry=None):
+    """
+    城市建筑数据的当前版本: 指定--buildings-source时为本地文件的版本, 否则见osm_buildings_version
+
+    Input:
+        entry: manifest中记录的版本
+
+    Output:
+        版本信息, 查询失败时记录到error.log并返回None
+    """
+    import incremental
+
+    try:
+        if args.buildings_source is not None:
+            return incremental.source_version(
+                os.path.join(args.buildings_source, f"buildings_{city}.geojson")
+            )
+        return osm_buildings_version(bounds_gdf, entry)
+    except KeyboardInterrupt:
+        sys.exit()
+    except Exception as e:
+        print("#" * 10 + f"Error@buildings version: {city}" + "#" * 10)
+        with open("./data/bldg/error.log", "a") as f:
+            f.write("#" * 20 + f"Error@buildings version: {city}" + "#" * 20 + "\n")
+            f.write(str(e) + "\n")
+        return None
+
+
+def osm_buildings_version(bounds_gdf, entry=None):
+    """
+    OSM建筑数据的版本: 数据时间戳和城市外包框内建筑(way和relation)的数量
+
+    Overpass的时间戳是全局的, 每分钟都会变化, 不能直接比较。已有记录时用newer查询记录的时间戳之后
+    外包框内有没有新增或修改的建筑, 没有且数量不变(没有删除)时沿用记录的版本, 不重新下载。
+    查询只返回数量(out count), 不下载建筑; 有变化时仍然重新下载整个城市
+    """
+    import osmnx as ox
+    import requests
+
+    response = requests.get(ox.settings.overpass_url + "/timestamp", timeout=100)
+    response.raise_for_status()
+    timestamp = response.text.strip()
+
+    left, bottom, right, top = bounds_gdf.total_bounds
+    bbox = f"({bottom},{left},{top},{right})"
+
+    def count(newer=""):
+        return (
+            f'(way["building"]{newer}{bbox};relation["building"]{newer}{bbox};);'
+            "out count;"
+        )
+
+    known = entry is not None and "osm_timestamp" in entry
+    query = "[out:json][timeout:180];" + count()
+    if known:
+        query += count(f'(newer:"{entry["osm_timestamp"]}")')
+    response = requests.post(
+        ox.settings.overpass_url + "/interpreter", data={"data": query}, timeout=200
+    )
+    response.raise_for_status()
+    counts = [int(e["tags"]["total"]) for e in response.json()["elements"]]
+
+    if known and counts[1] == 0 and counts[0] == entry.get("osm_count"):
+        return {"osm_timestamp": entry["osm_timestamp"], "osm_count": counts[0]}
+    return {"osm_timestamp": timestamp, "osm_count": counts[0]}
+
+
+def fetch_city_buildings(city, bounds_gdf, buildings_file):
+    """
+    获取城市的建筑数据, 指定--buildings-source时从本地文件复制, 否则从OSM下载
+    """
+    import shutil
+
+    import geopandas as gpd
+
+    if args.buildings_source is None:
+        return download_one_city_building_footprint(city, bounds_gdf, buildings_file)
+    source_file = os.path.join(args.buildings_source, f"buildings_{city}.geojson")
+    shutil.copyfile(source_file, buildings_file)
+    return gpd.read_file(buildings_file)
+
+
+def save_buildings_version(manifest_file, version, buildings_file):
+    """
+    在manifest中记录建筑数据的版本和内容hash
+    """
+    import incremental
+
+    manifest = incremental.load_manifest(manifest_file)
+    version["sha256"] = incremental.content_hash(open(buildings_file, "rb").read())
+    manifest["partitions"]["buildings"] = version
+    incremental.save_manifest(manifest, manifest_file)
+
+
+def save_raster_method(city, buildings_meta_file):
+    """
+    在manifest中记录栅格建筑面积的计算方法
+    """
+    import incremental
+
+    folder = os.path.dirname(buildings_meta_file)
+    manifest_file = os.path.join(folder, f"manifest_{city}.json")
+    manifest = incremental.load_manifest(manifest_file)
+    manifest["raster_method"] = RASTER_METHOD
+    incremental.save_manifest(manifest, manifest_file)
+
+
+def update_worldpop_raster(
+    bounds_gdf, old_gdf, new_gdf, worldpop_file, buildings_meta_file
+):
+    """
+    只重算新旧建筑有差异的栅格块
+
+    Output:
+        是否完成增量更新, 栅格大小变化时返回False, 需要全部重算
+    """
+    import numpy as np
+    from pyproj import Geod
+
+    import incremental
+    from coverage import coverage_pairs
+
+    geod = Geod(ellps="WGS84")
+
+    raster = open_worldpop_raster(bounds_gdf, worldpop_file)
+    shape = (raster.height, raster.width)
+    buildings_meta = np.load(buildings_meta_file)
+    if buildings_meta.shape != shape:
+        print("worldpop raster changed, recomputing all:", buildings_meta_file)
+        return False
+
+    removed, added = incremental.changed_geometries(
+        old_gdf["geometry"].values, new_gdf["geometry"].values
+    )
+    print(f"buildings removed: {len(removed)}, added: {len(added)}")
+    old_buildings = old_gdf.to_crs(raster.crs)["geometry"].values
+    buildings = new_gdf.to_crs(raster.crs)["geometry"].values
+    changed = np.concatenate([old_buildings[removed], buildings[added]])
+    blocks = incremental.touched_blocks(
+        coverage_pairs(changed, raster.transform, shape)[1], shape
+    )
+
+    # 用新版本中与这些栅格块相交的全部建筑重算
+    idx = incremental.block_buildings(buildings, raster.transform, shape, blocks)
+    area = [
+        abs(geod.geometry_area_perimeter(x)[0]) for x in new_gdf["geometry"].values[idx]
+    ]
+    buildings_meta = incremental.update_blocks(
+        buildings_meta, buildings[idx], area, raster.transform, blocks
+    )
+    print(
+        f"raster blocks recomputed: {len(blocks)}, buildings: {len(idx)}/{len(buildings)}"
+    )
+    np.save(buildings_meta_file, buildings_meta.astype(np.float32))
+    return True
+
+
+def refresh_city(city, bounds_gdf, folder):
+    """
+    增量更新一个城市: 建筑数据的版本(OSM时间戳或本地文件版本)和内容hash都没有变化时跳过,
+    否则只重算新旧建筑有差异的栅格块, 再替换建筑文件并更新manifest
+    """
+    import geopandas as gpd
+
+    import incremental
+
+    buildings_file = folder + f"buildings_{city}.geojson"
+    new_file = folder + f"buildings_{city}.new.geojson"
+    worldpop_file = folder + f"worldpop_{city}.tif"
+    buildings_meta_file = folder + f"agg_cell_buildings_area_{city}.npy"
+    manifest_file = folder + f"manifest_{city}.json"
+
+    manifest = incremental.load_manifest(manifest_file)
+    entry = manifest["partitions"].get("buildings")
+    version = buildings_version(city, bounds_gdf, entry)
+    if version is None:
+        return
+    if not incremental.version_changed(entry, version):
+        print("buildings unchanged:", city)
+        # 栅格不存在(上次计算失败或被删除)时用现有的建筑文件补算
+        download_worldpop_raster(
+            city,
+            bounds_gdf,
+            gpd.read_file(buildings_file),
+            worldpop_file,
+            buildings_meta_file,
+            workers=args.workers,
+        )
+        return
+    if entry is not None:
+        old_hash = entry["sha256"]
+    else:
+        old_hash = incremental.content_hash(open(buildings_file, "rb").read())
+
+    new_gdf = fetch_city_buildings(city, bounds_gdf, new_file)
+    if new_gdf is None:
+        return
+    if incremental.content_hash(open(new_file, "rb").read()) == old_hash:
+        print("buildings unchanged (same content):", city)
+        os.replace(new_file, buildings_file)
+    else:
+        # 没有记录方法的栅格(旧的geometry_mask结果)或方法不同时全部重算, 不混用两种方法
+        if (
+            os.path.exists(buildings_meta_file)
+            and manifest.get("raster_method") != RASTER_METHOD
+        ):
+            print("raster built by another method, recomputing all:", city)
+            os.remove(buildings_meta_file)
+        # 先更新栅格再替换建筑文件, 中断后重新运行会重算同样的栅格块
+        if os.path.exists(buildings_meta_file) and not update_worldpop_raster(
+            bounds_gdf,
+            gpd.read_file(buildings_file),
+            new_gdf,
+            worldpop_file,
+            buildings_meta_file,
+        ):
+            os.remove(buildings_meta_file)
+        os.replace(new_file, buildings_file)
+
+        visual_file = folder + f"visual_{city}.html"
+        if os.path.exists(visual_file):
+            os.remove(visual_file)
+        visualize_city_footprint(bounds_gdf, new_gdf, visual_file)
+
+    # 栅格不存在(方法不同, 栅格大小变化或上次计算失败)时全部重算, 已存在时直接返回
+    download_worldpop_raster(
+        city,
+        bounds_gdf,
+        new_gdf,
+        worldpop_file,
+        buildings_meta_file,
+        workers=args.workers,
+    )
+    # 栅格计算失败时不记录新版本, 下次刷新时重新计算
+    if os.path.exists(buildings_meta_file):
+        save_buildings_version(manifest_file, version, buildings_file)
+
+
 def main():
+    import geopandas as gpd
+
     cities = json.load(open("./data/bldg/cities.json"))
 
     for key, cities_list in cities.items():
@@ -232,12 +577,19 @@ def main():
 
             buildings_file = folder + f"buildings_{city}.geojson"
 
+            if args.refresh and os.path.exists(buildings_file):
+                refresh_city(city, bounds_gdf, folder)
+                continue
+
             if not os.path.exists(buildings_file):
-                buildings_gdf = download_one_city_building_footprint(
-                    city, bounds_gdf, buildings_file
-                )
+                version = buildings_version(city, bounds_gdf)
+                buildings_gdf = fetch_city_buildings(city, bounds_gdf, buildings_file)
                 if buildings_gdf is None:
                     continue
+                # 版本查询失败时不记录版本, 刷新时按内容hash判断是否变化
+                if version is not None:
+                    manifest_file = folder + f"manifest_{city}.json"
+                    save_buildings_version(manifest_file, version, buildings_file)
             else:
                 print("buildings file exists:", buildings_file)
                 buildings_gdf = gpd.read_file(buildings_file)
@@ -253,19 +605,49 @@ def main():
                 buildings_gdf,
                 worldpop_file,
                 buildings_meta_file,
+                workers=args.workers,
             )
 
     check_city_footprint(cities)
 
 
-if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
+def add_arguments(parser):
+    """
+    添加命令行参数, 供本脚本和buildings.py的world子命令共用
+    """
+    parser.add_argument(
+        "--mode",
+        type=str,
+        choices=["download", "check", "compare"],
+        default="download",
+    )
     parser.add_argument(
-        "--mode", type=str, choices=["download", "check"], default="download"
+        "--refresh",
+        action="store_true",
+        help="update only the raster blocks touched by changed buildings",
     )
+    parser.add_argument(
+        "--buildings-source",
+        type=str,
+        default=None,
+        help="read buildings_{city}.geojson from this folder instead of OSM",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="number of processes for the per-building stages",
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
     args = parser.parse_args()
 
     if args.mode == "download":
         main()
     elif args.mode == "check":
         check_city_footprint(json.load(open("./data/bldg/cities.json")))
+    elif args.mode == "compare":
+        compare_city_coverage(json.load(open("./data/bldg/cities.json")))
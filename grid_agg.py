@@ -0,0 +1,214 @@
+"""
+分层网格(quadkey)聚合
+
+在细粒度的quadkey网格上一次性计算可合并的部分统计量(数量, 和, 平方和, 最大值),
+粗粒度网格通过截断quadkey汇总, 任意区域通过网格与区域的重叠面积权重得到近似统计
+"""
+
+import numpy as np
+import pandas as pd
+import shapely
+
+SUM_COLUMNS = [
+    "count",
+    "area_sum",
+    "area_sq",
+    "height_sum",
+    "height_sq",
+    "volume_sum",
+    "volume_sq",
+    "complexity_sum",
+]
+MAX_COLUMNS = ["height_max"]
+
+
+def quadkey_index(lon, lat, zoom):
+    """
+    经纬度所在的quadkey(向量化), 以整数表示, 每层2bit, 与mercantile.quadkey的四进制一致
+
+    Input:
+        lon, lat: 经纬度数组(EPSG:4326)
+        zoom: 网格层级
+
+    Output:
+        key: int64数组
+    """
+    n = 1 << zoom
+    lat = np.clip(np.asarray(lat, dtype=np.float64), -85.0511287798, 85.0511287798)
+    x = np.floor((np.asarray(lon, dtype=np.float64) + 180.0) / 360.0 * n)
+    sin_lat = np.sin(np.radians(lat))
+    y = np.floor((0.5 - np.log((1 + sin_lat) / (1 - sin_lat)) / (4 * np.pi)) * n)
+    x = np.clip(x, 0, n - 1).astype(np.int64)
+    y = np.clip(y, 0, n - 1).astype(np.int64)
+
+    key = np.zeros_like(x)
+    for level in range(zoom - 1, -1, -1):
+        digit = ((x >> level) & 1) | (((y >> level) & 1) << 1)
+        key = (key << 2) | digit
+    return key
+
+
+def quadkey_bounds(key, zoom):
+    """
+    quadkey对应网格的经纬度范围(向量化)
+
+    Output:
+        (N, 4)的[minx, miny, maxx, maxy]
+    """
+    key = np.asarray(key, dtype=np.int64)
+    x = np.zeros_like(key)
+    y = np.zeros_like(key)
+    for level in range(zoom):
+        digit = (key >> (2 * level)) & 3
+        x |= (digit & 1) << level
+        y |= (digit >> 1) << level
+    n = 1 << zoom
+
+    def lat(y):
+        return np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n))))
+
+    return np.column_stack(
+        [x / n * 360.0 - 180.0, lat(y + 1), (x + 1) / n * 360.0 - 180.0, lat(y)]
+    )
+
+
+def cell_statistics(table, zoom):
+    """
+    以建筑中心点所在的quadkey网格计算部分统计量
+
+    Input:
+        table: 已计算area, complexity的BuildingTable
+        zoom: 细粒度网格层级
+
+    Output:
+        stats: {"key": 网格quadkey, SUM_COLUMNS/MAX_COLUMNS: 各网格的统计量}
+    """
+    bounds = shapely.bounds(table.geometry())
+    key = quadkey_index(
+        (bounds[:, 0] + bounds[:, 2]) / 2, (bounds[:, 1] + bounds[:, 3]) / 2, zoom
+    )
+    area = np.asarray(table.area)
+    height = np.asarray(table.height)
+    volume = area * height
+    values = {
+        "count": np.ones_like(area),
+        "area_sum": area,
+        "area_sq": area**2,
+        "height_sum": height,
+        "height_sq": height**2,
+        "volume_sum": volume,
+        "volume_sq": volume**2,
+        "complexity_sum": np.asarray(table.complexity),
+        "height_max": height,
+    }
+    return _group(key, values)
+
+
+def _group(key, values):
+    """
+    按key合并统计量, 求和列相加, 最大值列取最大
+    """
+    cells, inverse = np.unique(key, return_inverse=True)
+    stats = {"key": cells}
+    for name in SUM_COLUMNS:
+        stats[name] = np.bincount(inverse, weights=values[name], minlength=len(cells))
+    for name in MAX_COLUMNS:
+        stats[name] = np.full(len(cells), -np.inf)
+        np.maximum.at(stats[name], inverse, values[name])
+    return stats
+
+
+def merge(stats_list):
+    """
+    合并多份同一层级的部分统计量(如各数据分区), 同一网格的统计量相加或取最大
+    """
+    columns = ["key"] + SUM_COLUMNS + MAX_COLUMNS
+    values = {
+        name: np.concatenate([np.zeros(0)] + [s[name] for s in stats_list])
+        for name in columns
+    }
+    return _group(values["key"].astype(np.int64), values)
+
+
+def rollup(stats, zoom, coarse_zoom):
+    """
+    通过截断quadkey将统计量汇总到更粗的网格层级
+    """
+    assert coarse_zoom <= zoom, "coarse_zoom must not exceed zoom"
+    return _group(stats["key"] >> (2 * (zoom - coarse_zoom)), stats)
+
+
+def region_weights(gdf_region, stats, zoom):
+    """
+    计算区域与网格的重叠面积权重
+
+    Output:
+        region_idx, cell_idx, weight: 网格cell_idx有weight比例的面积位于区域region_idx内
+    """
+    b = quadkey_bounds(stats["key"], zoom)
+    cells = shapely.box(b[:, 0], b[:, 1], b[:, 2], b[:, 3])
+    cell_idx, region_idx = gdf_region.sindex.query(cells, predicate="intersects")
+    overlap = shapely.area(
+        shapely.intersection(cells[cell_idx], gdf_region.geometry.values[region_idx])
+    )
+    weight = overlap / shapely.area(cells[cell_idx])
+    keep = weight > 0
+    return region_idx[keep], cell_idx[keep], weight[keep]
+
+
+def map_to_regions(stats, gdf_region, zoom):
+    """
+    按重叠面积权重将网格统计量分配到区域
+
+    Output:
+        DataFrame, 每个区域(GEOID)一行, 列为加权后的SUM_COLUMNS与MAX_COLUMNS
+    """
+    region_idx, cell_idx, weight = region_weights(gdf_region, stats, zoom)
+    n = gdf_region.shape[0]
+    result = {"GEOID": gdf_region["GEOID"].to_numpy()}
+    for name in SUM_COLUMNS:
+        result[name] = np.bincount(
+            region_idx, weights=stats[name][cell_idx] * weight, minlength=n
+        )
+    for name in MAX_COLUMNS:
+        result[name] = np.full(n, -np.inf)
+        np.maximum.at(result[name], region_idx, stats[name][cell_idx])
+    return pd.DataFrame(result)
+
+
+def finalize(stats):
+    """
+    由部分统计量计算最终指标, 列名与BuildingTable.aggregate一致, 另加数量, 标准差和最大值
+    """
+    df = pd.DataFrame(stats)
+    count = df["count"].where(df["count"] > 0)
+
+    def std(name):
+        mean = df[f"{name}_sum"] / count
+        return np.sqrt((df[f"{name}_sq"] / count - mean**2).clip(lower=0))
+
+    df = df.assign(
+        building_num=df["count"],
+        area_mean=df["area_sum"] / count,
+        area_std=std("area"),
+        height_mean=df["height_sum"] / count,
+        height_std=std("height"),
+        volume_std=std("volume"),
+        complexity_mean=df["complexity_sum"] / count,
+        height_max=df["height_max"].where(np.isfinite(df["height_max"])),
+    )
+    drop = ["count", "area_sq", "height_sum", "height_sq", "volume_sq"]
+    return df.drop(columns=drop + ["complexity_sum"])
+
+
+def save_multiscale(stats, zoom, coarse_zoom, path):
+    """
+    保存zoom到coarse_zoom各层级的网格统计量到一个npz文件, 键为{层级}_{列名}
+    """
+    arrays = {}
+    for z in range(zoom, coarse_zoom - 1, -1):
+        level = stats if z == zoom else rollup(stats, zoom, z)
+        for name, values in level.items():
+            arrays[f"{z}_{name}"] = values
+    np.savez(path, **arrays)
+    print("grid stats saved:", path)
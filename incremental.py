@@ -0,0 +1,214 @@
+"""
+增量更新
+
+每个数据分区(MS的quadkey文件, 世界城市的OSM建筑)在manifest中记录来源版本(URL, ETag, Last-Modified,
+大小, OSM时间戳和建筑数量)和内容的sha256; 刷新时只重新处理版本变化的分区, 再只重算受影响的区域或栅格块。
+数据来源可以是http(s) URL, file:// URL或本地路径, 便于用本地的多个版本文件测试
+"""
+
+import os
+import json
+import hashlib
+import urllib.parse
+import urllib.request
+
+import numpy as np
+import shapely
+
+# 增量重算栅格建筑面积时的栅格块大小
+BLOCK_SIZE = 256
+
+
+def local_path(url):
+    """
+    file:// URL或本地路径对应的文件路径, http(s) URL返回None
+    """
+    parsed = urllib.parse.urlparse(url)
+    if parsed.scheme == "file":
+        return urllib.request.url2pathname(parsed.path)
+    if parsed.scheme in ("http", "https"):
+        return None
+    return url
+
+
+def open_source(url):
+    """
+    读取URL或本地文件的内容
+    """
+    path = local_path(url)
+    if path is not None:
+        with open(path, "rb") as f:
+            return f.read()
+    with urllib.request.urlopen(url) as response:
+        return response.read()
+
+
+def source_version(url):
+    """
+    不下载内容, 获得来源的版本信息: http(s)用HEAD请求的ETag, Last-Modified和大小, 本地文件用修改时间和大小
+    """
+    path = local_path(url)
+    if path is not None:
+        stat = os.stat(path)
+        return {
+            "url": url,
+            "etag": None,
+            "last_modified": stat.st_mtime_ns,
+            "size": stat.st_size,
+        }
+    request = urllib.request.Request(url, method="HEAD")
+    with urllib.request.urlopen(request) as response:
+        headers = response.headers
+        return {
+            "url": url,
+            "etag": headers.get("ETag"),
+            "last_modified": headers.get("Last-Modified"),
+            "size": int(headers.get("Content-Length", -1)),
+        }
+
+
+def content_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def geometry_hash(geometry):
+    """
+    建筑几何(WKB)的sha256, 用于判断内存中的建筑数据是否变化
+    """
+    digest = hashlib.sha256()
+    for wkb in shapely.to_wkb(np.asarray(geometry, dtype=object)):
+        digest.update(wkb)
+    return digest.hexdigest()
+
+
+def load_manifest(manifest_file):
+    """
+    读取manifest, 不存在时返回空的manifest
+    """
+    if not os.path.exists(manifest_file):
+        return {"key": None, "partitions": {}}
+    return json.load(open(manifest_file))
+
+
+def save_manifest(manifest, manifest_file):
+    """
+    保存manifest, 先写临时文件再改名, 中断时不会留下不完整的manifest
+    """
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_file, manifest_file)
+
+
+def version_changed(entry, version):
+    """
+    比较manifest中分区的版本与来源当前的版本, 没有记录时视为已变化
+    """
+    if entry is None:
+        return True
+    for name in ["url", "etag", "last_modified", "size", "osm_timestamp", "osm_count"]:
+        if entry.get(name) != version.get(name):
+            return True
+    return False
+
+
+def region_key(gdf_region):
+    """
+    区域(tract)的GEOID和几何的hash, 区域变化时所有分区都需要重新连接
+    """
+    digest = hashlib.sha256()
+    digest.update("\n".join(gdf_region["GEOID"].astype(str)).encode())
+    for wkb in shapely.to_wkb(gdf_region["geometry"].values):
+        digest.update(wkb)
+    return digest.hexdigest()
+
+
+def changed_geometries(old, new):
+    """
+    比较新旧两个版本的建筑几何
+
+    Output:
+        removed: old中在new里不存在的建筑下标
+        added: new中在old里不存在的建筑下标
+    """
+    old_wkb = shapely.to_wkb(shapely.normalize(np.asarray(old, dtype=object)))
+    new_wkb = shapely.to_wkb(shapely.normalize(np.asarray(new, dtype=object)))
+    # np.isin对object数组逐个比较, 复杂度为平方级, 这里用集合查找
+    old_set = set(old_wkb)
+    new_set = set(new_wkb)
+    return (
+        np.flatnonzero(
+            np.fromiter((w not in new_set for w in old_wkb), bool, len(old_wkb))
+        ),
+        np.flatnonzero(
+            np.fromiter((w not in old_set for w in new_wkb), bool, len(new_wkb))
+        ),
+    )
+
+
+def touched_blocks(cell_idx, shape, block_size=BLOCK_SIZE):
+    """
+    栅格(展平下标)所在的栅格块编号
+    """
+    row, col = np.divmod(np.asarray(cell_idx, dtype=np.int64), shape[1])
+    n_block_cols = -(-shape[1] // block_size)
+    return np.unique((row // block_size) * n_block_cols + col // block_size)
+
+
+def block_mask(blocks, shape, block_size=BLOCK_SIZE):
+    """
+    属于给定栅格块的栅格, (height, width)的布尔数组
+    """
+    n_block_cols = -(-shape[1] // block_size)
+    row = np.arange(shape[0]) // block_size
+    col = np.arange(shape[1]) // block_size
+    return np.isin(row[:, None] * n_block_cols + col[None, :], blocks)
+
+
+def block_buildings(geometry, transform, shape, blocks, block_size=BLOCK_SIZE):
+    """
+    与给定栅格块相交的建筑下标
+
+    Input:
+        geometry: 建筑几何(栅格坐标系)
+        transform, shape: 栅格的仿射变换和(height, width)
+        blocks: 栅格块编号, 见touched_blocks
+    """
+    a, _, c, _, e, f = transform[:6]
+    n_block_cols = -(-shape[1] // block_size)
+    block_row, block_col = np.divmod(np.asarray(blocks), n_block_cols)
+    x0 = c + block_col * block_size * a
+    y0 = f + block_row * block_size * e
+    boxes = shapely.box(x0, y0 + block_size * e, x0 + block_size * a, y0)
+    tree = shapely.STRtree(boxes)
+    return np.unique(tree.query(geometry, predicate="intersects")[0])
+
+
+def update_blocks(raster, geometry, area, transform, blocks, block_size=BLOCK_SIZE):
+    """
+    重算给定栅格块内的栅格建筑面积, 其余栅格不变
+
+    Input:
+        raster: 旧的(height, width)栅格建筑面积
+        geometry: 新版本中与栅格块相交的建筑几何(栅格坐标系), 见block_buildings
+        area: 这些建筑的面积
+        transform: 栅格的仿射变换
+        blocks: 需要重算的栅格块编号
+    """
+    from coverage import coverage_pairs
+
+    shape = raster.shape
+    mask = block_mask(blocks, shape, block_size)
+    raster = np.asarray(raster, dtype=np.float64).copy()
+    raster[mask] = 0
+    if len(geometry) == 0:
+        return raster
+
+    building_idx, cell_idx, fraction = coverage_pairs(geometry, transform, shape)
+    keep = mask.ravel()[cell_idx]
+    raster += np.bincount(
+        cell_idx[keep],
+        weights=np.asarray(area)[building_idx[keep]] * fraction[keep],
+        minlength=raster.size,
+    ).reshape(shape)
+    return raster
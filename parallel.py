@@ -0,0 +1,301 @@
+"""
+逐建筑步骤的多进程分片执行
+
+建筑按Hilbert序切成空间上紧凑的分片, 几何以坐标数组(ragged数组)放在共享内存中,
+子进程按名称读取而不是pickle GeoDataFrame; 需要读栅格的步骤每个子进程各自打开一个rasterio句柄;
+结果按分片顺序收集, 与单进程的结果一致
+"""
+
+import re
+import json
+import atexit
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import shapely
+
+# 子进程中的共享数组和栅格句柄, 由_attach设置
+_arrays = {}
+_blocks = []
+_spec = None
+_raster = None
+_raster_path = None
+# 主进程中复用的进程池, 见get_pool
+_pool = None
+_pool_workers = None
+
+# GeoJSON行中第一个顶点的坐标
+_FIRST_COORDINATE = re.compile(
+    rb'"coordinates"\s*:\s*\[+\s*(-?[0-9.eE+-]+)\s*,\s*(-?[0-9.eE+-]+)'
+)
+
+
+class SharedArrays:
+    """
+    把一组NumPy数组复制到共享内存, spec只包含名称, 形状和类型, 可以廉价地传给子进程
+    """
+
+    def __init__(self, arrays):
+        self.blocks = []
+        self.spec = {}
+        for name, values in arrays.items():
+            values = np.ascontiguousarray(values)
+            shm = SharedMemory(create=True, size=max(values.nbytes, 1))
+            np.ndarray(values.shape, values.dtype, buffer=shm.buf)[...] = values
+            self.blocks.append(shm)
+            self.spec[name] = (shm.name, values.shape, values.dtype.str)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+
+
+def _attach(spec, raster_path):
+    """
+    子进程按spec连接共享数组, 打开栅格; 与上一个任务相同时直接复用
+    """
+    global _arrays, _raster, _spec, _raster_path
+    if spec != _spec:
+        # 先释放数组再关闭共享内存
+        _arrays = {}
+        for shm in _blocks:
+            shm.close()
+        _blocks.clear()
+        arrays = {}
+        for name, (shm_name, shape, dtype) in spec.items():
+            shm = SharedMemory(name=shm_name)
+            _blocks.append(shm)
+            arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+        _arrays = arrays
+        _spec = spec
+    if raster_path != _raster_path:
+        if _raster is not None:
+            _raster.close()
+        _raster = None
+        if raster_path is not None:
+            import rasterio
+
+            _raster = rasterio.open(raster_path)
+        _raster_path = raster_path
+
+
+def ragged_arrays(geometry, prefix=""):
+    """
+    把几何转换为可放入共享内存的ragged数组字典
+    """
+    geometry_type, coords, offsets = shapely.to_ragged_array(
+        np.asarray(geometry, dtype=object)
+    )
+    arrays = {
+        f"{prefix}geometry_type": np.array([int(geometry_type)]),
+        f"{prefix}coords": coords,
+    }
+    for i, level in enumerate(offsets):
+        arrays[f"{prefix}offsets_{i}"] = level
+    return arrays
+
+
+def worker_geometry(idx, prefix=""):
+    """
+    在子进程中从共享的ragged数组还原idx对应的几何
+    """
+    from building_table import take_ragged
+
+    offsets = []
+    while f"{prefix}offsets_{len(offsets)}" in _arrays:
+        offsets.append(_arrays[f"{prefix}offsets_{len(offsets)}"])
+    coords, offsets = take_ragged(_arrays[f"{prefix}coords"], offsets, idx)
+    geometry_type = shapely.GeometryType(int(_arrays[f"{prefix}geometry_type"][0]))
+    return shapely.from_ragged_array(geometry_type, coords, offsets)
+
+
+def spatial_shards(bounds, n_shards):
+    """
+    按外包框中心的Hilbert序把建筑切成n_shards个空间上紧凑的分片
+
+    Output:
+        shards: 建筑下标数组的列表
+    """
+    from building_query import hilbert_order
+
+    order = hilbert_order(bounds)
+    return [s for s in np.array_split(order, n_shards) if len(s)]
+
+
+def get_pool(workers):
+    """
+    本次运行共用的进程池, 第一次使用时创建, 进程数变化时重建, 退出时关闭;
+    避免每次map_shards都重新启动进程(spawn时每个进程都要重新导入依赖)
+    """
+    global _pool, _pool_workers
+    if _pool is None or _pool_workers != workers:
+        close_pool()
+        _pool = Pool(workers)
+        _pool_workers = workers
+    return _pool
+
+
+def close_pool():
+    global _pool
+    if _pool is not None:
+        _pool.close()
+        _pool.join()
+        _pool = None
+
+
+atexit.register(close_pool)
+
+
+def map_shards(task, arrays, shards, workers=1, raster_path=None):
+    """
+    对每个分片执行task, 结果按分片顺序返回
+
+    Input:
+        task: 模块级函数task(idx) -> {名称: 数组}, 在子进程中通过worker_geometry等读取共享数据
+        arrays: 放入共享内存的数组字典
+        shards: 分片(下标数组)的列表
+        workers: 进程数, 为1时在当前进程中执行
+        raster_path: 每个子进程各自打开的栅格文件
+    """
+    if workers <= 1:
+        _init_local(arrays, raster_path)
+        return [task(shard) for shard in shards]
+    with SharedArrays(arrays) as shared:
+        jobs = [(task, shared.spec, raster_path, shard) for shard in shards]
+        return get_pool(workers).map(_run_task, jobs, chunksize=1)
+
+
+def _run_task(job):
+    task, spec, raster_path, idx = job
+    _attach(spec, raster_path)
+    return task(idx)
+
+
+def _init_local(arrays, raster_path):
+    global _arrays, _raster
+    _arrays = arrays
+    _raster = None
+    if raster_path is not None:
+        import rasterio
+
+        _raster = rasterio.open(raster_path)
+
+
+def scatter(results, shards, n, name):
+    """
+    把逐建筑的分片结果按原始顺序放回长度为n的数组
+    """
+    out = np.full(n, np.nan)
+    for result, shard in zip(results, shards):
+        out[shard] = result[name]
+    return out
+
+
+def features_task(idx):
+    """
+    分片计算建筑的测地面积与ERI
+    """
+    from building_table import building_features
+
+    area, complexity = building_features(worker_geometry(idx))
+    return {"area": area, "complexity": complexity}
+
+
+def raster_max_task(idx):
+    """
+    分片计算每个建筑轮廓内栅格的最大值(CNBH建筑高度)
+    """
+    from rasterio.mask import mask
+
+    geometry = worker_geometry(idx)
+    height = [np.max(np.nan_to_num(mask(_raster, [x], crop=True)[0])) for x in geometry]
+    return {"height": np.asarray(height, dtype=float)}
+
+
+def coverage_task(idx):
+    """
+    分片计算建筑的测地面积并按覆盖比例分配到栅格
+
+    共享数组: 栅格坐标系的几何, "geo_"前缀的EPSG:4326几何, 栅格的transform和shape
+    """
+    from pyproj import Geod
+
+    from coverage import coverage_pairs
+
+    geod = Geod(ellps="WGS84")
+    area = np.array(
+        [abs(geod.geometry_area_perimeter(x)[0]) for x in worker_geometry(idx, "geo_")]
+    )
+    building_idx, cell_idx, fraction = coverage_pairs(
+        worker_geometry(idx), tuple(_arrays["transform"]), tuple(_arrays["shape"])
+    )
+    return {"cell": cell_idx, "value": area[building_idx] * fraction}
+
+
+def parse_task(idx):
+    """
+    分片解析GeoJSON行(Microsoft建筑数据), 返回几何的ragged数组和高度
+
+    共享数组: lines为所有行拼接后的字节, 第i行为lines[line_starts[i]:line_ends[i]];
+    有keep_keys, keep_zooms(见tile_plan.plan_tiles)时, 第一个顶点不在保留网格中的建筑不解析
+    """
+    from shapely.geometry import shape
+
+    data = _arrays["lines"]
+    starts = _arrays["line_starts"]
+    ends = _arrays["line_ends"]
+    n_lines = len(idx)
+    if "keep_keys" in _arrays:
+        idx = idx[_keep_lines(idx)]
+    geometry = []
+    height = []
+    for i in idx:
+        feature = json.loads(data[starts[i] : ends[i]].tobytes())
+        geometry.append(shape(feature["geometry"]))
+        height.append(feature["properties"]["height"])
+    result = ragged_arrays(geometry) if geometry else {}
+    result["height"] = np.asarray(height, dtype=np.float64)
+    result["skipped"] = np.array([n_lines - len(idx)])
+    return result
+
+
+def _keep_lines(idx):
+    """
+    用正则取出每行第一个顶点的坐标(不解析整行JSON), 判断是否落在保留网格中
+    """
+    from tile_plan import keep_mask
+
+    data = _arrays["lines"]
+    starts = _arrays["line_starts"]
+    ends = _arrays["line_ends"]
+    lon = np.full(len(idx), np.nan)
+    lat = np.full(len(idx), np.nan)
+    for j, i in enumerate(idx):
+        match = _FIRST_COORDINATE.search(data[starts[i] : ends[i]].tobytes())
+        if match is not None:
+            lon[j], lat[j] = float(match.group(1)), float(match.group(2))
+    # 取不到坐标的行照常解析
+    found = ~np.isnan(lon)
+    keep = np.ones(len(idx), dtype=bool)
+    keep[found] = keep_mask(
+        lon[found], lat[found], _arrays["keep_keys"], _arrays["keep_zooms"]
+    )
+    return keep
+
+
+def result_geometry(result):
+    """
+    由parse_task的结果还原几何
+    """
+    if "coords" not in result:
+        return np.array([], dtype=object)
+    offsets = []
+    while f"offsets_{len(offsets)}" in result:
+        offsets.append(result[f"offsets_{len(offsets)}"])
+    geometry_type = shapely.GeometryType(int(result["geometry_type"][0]))
+    return shapely.from_ragged_array(geometry_type, result["coords"], offsets)
@@ -0,0 +1,141 @@
+"""
+增量更新(--refresh)的测试: 用fixtures/incremental中两个版本的本地数据, 先处理v1再换成v2刷新,
+结果应与直接处理v2一致
+
+    python -m pytest tests
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+
+import numpy as np
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "tests", "fixtures", "incremental")
+sys.path.insert(0, ROOT)
+
+gpd = pytest.importorskip("geopandas")
+rasterio = pytest.importorskip("rasterio")
+
+
+def parse_args(module, argv):
+    parser = argparse.ArgumentParser()
+    module.add_arguments(parser)
+    module.args = parser.parse_args(argv)
+
+
+def run_ms(monkeypatch, folder, version, refresh=False):
+    """
+    在folder中用version版本的quadkey文件运行get_MS_buildings, 返回region2info_building.json
+    """
+    import get_MS_buildings
+
+    ms_folder = os.path.join(folder, "ms")
+    os.makedirs(ms_folder, exist_ok=True)
+    for name in os.listdir(os.path.join(FIXTURES, "ms", "v1")):
+        source = os.path.join(FIXTURES, "ms", version, name)
+        if not os.path.exists(source):
+            source = os.path.join(FIXTURES, "ms", "v1", name)
+        shutil.copyfile(source, os.path.join(ms_folder, name))
+    shutil.copyfile(
+        os.path.join(FIXTURES, "ms", "dataset-links.csv"),
+        os.path.join(ms_folder, "dataset-links.csv"),
+    )
+    os.makedirs(os.path.join(folder, "data", "data_DC"), exist_ok=True)
+
+    gdf_region = gpd.read_file(os.path.join(FIXTURES, "ms", "tracts.geojson"))
+    monkeypatch.chdir(folder)
+    monkeypatch.setattr(get_MS_buildings, "get_gdf_region", lambda city: gdf_region)
+    monkeypatch.setattr(get_MS_buildings, "get_statistics", lambda gdf: gdf)
+    monkeypatch.setattr(get_MS_buildings, "visualize_region", lambda *a: None)
+    argv = ["--city", "DC", "--links", "ms/dataset-links.csv"]
+    parse_args(get_MS_buildings, argv + (["--refresh"] if refresh else []))
+    get_MS_buildings.main("DC")
+    return json.load(open("data/data_DC/region2info_building.json"))
+
+
+def run_world(monkeypatch, folder, version, refresh=False):
+    """
+    在folder中用version版本的buildings_{city}.geojson运行get_world_city_footprint, 返回栅格建筑面积
+    """
+    import get_world_city_footprint
+    from rasterio.transform import from_origin
+
+    city_folder = os.path.join(folder, "data", "bldg", "US")
+    source_folder = os.path.join(folder, "source")
+    os.makedirs(city_folder, exist_ok=True)
+    os.makedirs(source_folder, exist_ok=True)
+    with open(os.path.join(folder, "data", "bldg", "cities.json"), "w") as f:
+        json.dump({"US": ["Testville"]}, f)
+    shutil.copyfile(
+        os.path.join(FIXTURES, "world", "bounds_Testville.geojson"),
+        os.path.join(city_folder, "bounds_Testville.geojson"),
+    )
+    shutil.copyfile(
+        os.path.join(FIXTURES, "world", version, "buildings_Testville.geojson"),
+        os.path.join(source_folder, "buildings_Testville.geojson"),
+    )
+    # 0.0005度的WorldPop栅格, 400×600, 增量更新时分为2×3个栅格块
+    worldpop_file = os.path.join(city_folder, "worldpop_Testville.tif")
+    if not os.path.exists(worldpop_file):
+        with rasterio.open(
+            worldpop_file,
+            "w",
+            driver="GTiff",
+            height=400,
+            width=600,
+            count=1,
+            dtype="float32",
+            crs="EPSG:4326",
+            transform=from_origin(-77.2, 39.0, 0.0005, 0.0005),
+        ) as f:
+            f.write(np.ones((1, 400, 600), dtype=np.float32))
+
+    monkeypatch.chdir(folder)
+    monkeypatch.setattr(
+        get_world_city_footprint, "visualize_city_footprint", lambda *a: None
+    )
+    argv = ["--buildings-source", source_folder]
+    parse_args(get_world_city_footprint, argv + (["--refresh"] if refresh else []))
+    get_world_city_footprint.main()
+    return np.load("data/bldg/US/agg_cell_buildings_area_Testville.npy")
+
+
+def test_ms_refresh_matches_full_rebuild(tmp_path, monkeypatch):
+    run_ms(monkeypatch, str(tmp_path / "refresh"), "v1")
+    refreshed = run_ms(monkeypatch, str(tmp_path / "refresh"), "v2", refresh=True)
+    full = run_ms(monkeypatch, str(tmp_path / "full"), "v2")
+
+    assert refreshed.keys() == full.keys()
+    for geoid in full:
+        assert refreshed[geoid] == pytest.approx(full[geoid])
+
+
+def test_ms_refresh_unchanged(tmp_path, monkeypatch, capsys):
+    full = run_ms(monkeypatch, str(tmp_path), "v1")
+    refreshed = run_ms(monkeypatch, str(tmp_path), "v1", refresh=True)
+
+    assert "no partition changed" in capsys.readouterr().out
+    assert refreshed == full
+
+
+def test_world_refresh_matches_full_rebuild(tmp_path, monkeypatch, capsys):
+    old = run_world(monkeypatch, str(tmp_path / "refresh"), "v1")
+    refreshed = run_world(monkeypatch, str(tmp_path / "refresh"), "v2", refresh=True)
+    full = run_world(monkeypatch, str(tmp_path / "full"), "v2")
+
+    assert "raster blocks recomputed" in capsys.readouterr().out
+    assert not np.allclose(old, full)
+    np.testing.assert_allclose(refreshed, full, rtol=1e-6, atol=1e-3)
+
+
+def test_world_refresh_rebuilds_missing_raster(tmp_path, monkeypatch):
+    full = run_world(monkeypatch, str(tmp_path), "v1")
+    os.remove("data/bldg/US/agg_cell_buildings_area_Testville.npy")
+    refreshed = run_world(monkeypatch, str(tmp_path), "v1", refresh=True)
+
+    np.testing.assert_allclose(refreshed, full)
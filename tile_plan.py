@@ -0,0 +1,120 @@
+"""
+MS建筑数据的quadkey下载规划
+
+MS建筑数据按9级quadkey分文件, 直接用区域外包框选文件时, 不规则或沿海的区域会下载大量与区域无关的文件。
+这里用区域几何的并集逐层细分quadkey网格: 与并集不相交的网格丢弃, 被并集完全覆盖的网格保留,
+其余继续细分到max_zoom。只下载保留网格所在的9级文件, 解析时跳过落在丢弃网格中的建筑
+"""
+
+import os
+import re
+import urllib.request
+
+import numpy as np
+import shapely
+
+from grid_agg import quadkey_bounds, quadkey_index
+
+SIZE_UNITS = {"B": 1, "KB": 1 << 10, "MB": 1 << 20, "GB": 1 << 30}
+
+
+def plan_tiles(region, zoom=9, max_zoom=13):
+    """
+    逐层细分quadkey网格, 得到与区域相交的网格
+
+    Input:
+        region: 区域几何(EPSG:4326), 如所有tract的并集
+        zoom: 数据文件的quadkey层级
+        max_zoom: 细分的最细层级
+
+    Output:
+        tiles: 需要下载的zoom层quadkey(整数, 每层2bit)
+        keep_keys, keep_zooms: 保留的网格及其层级, 包括zoom到max_zoom之间被区域完全覆盖的网格
+            和max_zoom层与区域边界相交的网格
+    """
+    shapely.prepare(region)
+    keys = np.zeros(1, dtype=np.int64)
+    keep_keys = []
+    keep_zooms = []
+    for z in range(max_zoom + 1):
+        boxes = shapely.box(*quadkey_bounds(keys, z).T)
+        keys = keys[shapely.intersects(region, boxes)]
+        if z >= zoom:
+            if z == max_zoom:
+                full = np.ones(len(keys), dtype=bool)
+            else:
+                full = shapely.covers(region, shapely.box(*quadkey_bounds(keys, z).T))
+            keep_keys.append(keys[full])
+            keep_zooms.append(np.full(full.sum(), z))
+            keys = keys[~full]
+        # 子网格的quadkey在末尾追加一位四进制数
+        keys = ((keys[:, None] << 2) | np.arange(4)).ravel()
+
+    keep_keys = np.concatenate(keep_keys)
+    keep_zooms = np.concatenate(keep_zooms)
+    tiles = np.unique(keep_keys >> (2 * (keep_zooms - zoom)))
+    return tiles, keep_keys, keep_zooms
+
+
+def keep_mask(lon, lat, keep_keys, keep_zooms):
+    """
+    点是否落在plan_tiles保留的网格中(向量化)
+    """
+    max_zoom = int(keep_zooms.max())
+    key = quadkey_index(lon, lat, max_zoom)
+    mask = np.zeros(len(key), dtype=bool)
+    for z in np.unique(keep_zooms):
+        mask |= np.isin(key >> (2 * (max_zoom - z)), keep_keys[keep_zooms == z])
+    return mask
+
+
+def covered_fraction(keep_keys, keep_zooms, zoom):
+    """
+    保留网格占所下载的zoom层网格的比例(按网格个数折算, 近似面积比例)
+    """
+    n_tiles = len(np.unique(keep_keys >> (2 * (keep_zooms - zoom))))
+    return float(np.sum(0.25 ** (keep_zooms - zoom)) / n_tiles) if n_tiles else 0.0
+
+
+def ms_quadkey(key, zoom):
+    """
+    整数quadkey转为dataset-links.csv中QuadKey列的写法(四进制数字按十进制读出)
+    """
+    key = np.asarray(key, dtype=np.int64)
+    out = np.zeros_like(key)
+    for level in range(zoom - 1, -1, -1):
+        out = out * 10 + ((key >> (2 * level)) & 3)
+    return out
+
+
+def parse_size(size):
+    """
+    解析dataset-links.csv中Size列的写法, 如"74.1KB", 无法解析时返回None
+    """
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMG]?B)\s*", str(size), re.IGNORECASE)
+    if match is None:
+        return None
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).upper()])
+
+
+def download_size(rows):
+    """
+    预计下载量, 优先使用Size列, 没有时本地文件用文件大小, URL用HEAD请求的Content-Length
+
+    Input:
+        rows: dataset-links.csv中要下载的行
+    """
+    from incremental import local_path
+
+    total = 0
+    for _, row in rows.iterrows():
+        size = parse_size(row["Size"]) if "Size" in row else None
+        path = local_path(row["Url"])
+        if size is None and path is not None:
+            size = os.path.getsize(path)
+        if size is None:
+            request = urllib.request.Request(row["Url"], method="HEAD")
+            with urllib.request.urlopen(request) as response:
+                size = int(response.headers.get("Content-Length", 0))
+        total += size
+    return total
@@ -0,0 +1,15 @@
+"""
+MS和CN流程共用的小工具
+"""
+
+import numpy as np
+
+
+def standardize(values):
+    """
+    按列标准化(减均值除以标准差), 与sklearn的StandardScaler一致, 标准差为0的列只减均值
+    """
+    values = np.asarray(values, dtype=np.float64)
+    std = values.std(axis=0)
+    std[std == 0] = 1.0
+    return (values - values.mean(axis=0)) / std